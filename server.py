@@ -8,82 +8,188 @@
 # - EM lines follow the same selected week (Current/Next)
 # ============================================================
 
-import os, json, datetime as dt, requests, time, math
-from flask import Flask, jsonify, Response
+import os
+
+# 🔹 خادم غير متزامن (gevent): كل اتصال /stream أو /stream/poll = greenlet خفيف بدل thread.
+#    الـ patch لازم قبل أي import آخر (socket / threading / requests)، وفقط عند التشغيل المباشر
+#    (عمليات الـ compute pool لا تُرقّع). SERVER_MODE=threaded → werkzeug التقليدي (thread لكل طلب).
+SERVER_MODE = os.environ.get("SERVER_MODE", "gevent").lower()
+ASYNC_SERVER = False
+if SERVER_MODE == "gevent" and __name__ == "__main__":
+    from gevent import monkey
+    monkey.patch_all()
+    ASYNC_SERVER = True
+
+import json, datetime as dt, requests, time, math, threading, random, heapq, hashlib, gzip, re, sqlite3, atexit, mmap, struct, zlib, base64, multiprocessing
+from array import array
+from collections import deque
+from types import MappingProxyType
+from zoneinfo import ZoneInfo
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+import numpy as np
+from flask import Flask, jsonify, Response, request
+from markupsafe import Markup
 
 DATA_PATH = "/opt/render/project/src/data"
-os.makedirs(DATA_PATH, exist_ok=True)
+ALL_FILE = f"{DATA_PATH}/all.json"  # الصيغة القديمة: تُستورد مرة واحدة إلى SnapshotStore
 
-# ============================================================
-# 🧠 تحميل ملف all.json بأمان (إصلاح خطأ list has no attribute get)
-# ============================================================
-import json
-
-ALL_FILE = f"{DATA_PATH}/all.json"
-all_data = {}
-
-if os.path.exists(ALL_FILE):
-    try:
-        with open(ALL_FILE, "r", encoding="utf-8") as f:
-            all_data = json.load(f)
-
-        # ✅ حماية من تلف البيانات
-        if isinstance(all_data, list):
-            print("[WARN] all_data was list → resetting to empty dict")
-            all_data = {}
-        elif isinstance(all_data, dict) and isinstance(all_data.get("data"), list):
-            print("[WARN] all_data['data'] was list → converting")
-            all_data["data"] = {}
-    except Exception as e:
-        print(f"[ERROR] Failed to load all_data: {e}")
-        all_data = {}
-else:
-    all_data = {}
-
-# ✅ ضمان أن المتغير النهائي هو قاموس
-if not isinstance(all_data, dict):
-    all_data = {}
+# 🔹 لا كتابة على القرص عند الـ import: المجلد يُنشأ عند أول كتابة فقط
+_DATA_DIR_READY = False
+def _ensure_data_dir():
+    global _DATA_DIR_READY
+    if not _DATA_DIR_READY:
+        os.makedirs(DATA_PATH, exist_ok=True)
+        _DATA_DIR_READY = True
+    return DATA_PATH
 
 
 app = Flask(__name__)
 POLY_KEY = (os.environ.get("POLYGON_API_KEY") or os.environ.get("POLYGON_API") or "").strip()
 BASE_SNAP = "https://api.polygon.io/v3/snapshot/options"
+BASE_REF  = "https://api.polygon.io/v3/reference/options"
 TODAY     = dt.date.today
 
-# إنشاء ملف all.json الافتراضي إذا ما كان موجود
-if not os.path.exists(f"{DATA_PATH}/all.json"):
-    with open(f"{DATA_PATH}/all.json", "w", encoding="utf-8") as f:
-        json.dump({"updated": None, "symbols": [], "data": {}}, f, ensure_ascii=False, indent=2)
-
-# 🔹 إنشاء ملف الفرص إذا غير موجود (يمنع رسالة "لم يتم إنشاء أي فرص بعد.")
-open(f"{DATA_PATH}/opportunities.json", "a").close()
-
 
 SYMBOLS = [
     "AAPL","META","MSFT","NVDA","TSLA","GOOGL","AMD",
     "CRWD","SPY","PLTR","LULU","LLY","COIN","MSTR","APP","ASML"
 ]
 
-CACHE = {}
 CACHE_EXPIRY = 3600  # 1h
 
-# ⏱️ Baselines (نحفظ خط أساس يومي للمقارنة Δ)
-# structure: DAILY_BASE[symbol][expiry] = {"date":"YYYY-MM-DD","calls":x,"puts":y,"iv_atm":z}
-DAILY_BASE = {}
+# ⏱️ Baselines (نحفظ خط أساس أسبوعي للمقارنة Δ)
+# structure: [symbol][expiry][week_key] = {"timestamp":..., "calls":x, "puts":y, "iv_atm":z}
 BASELINE_PATH = f"{DATA_PATH}/baseline.json"
-def load_baseline():
-    global DAILY_BASE
-    if os.path.exists(BASELINE_PATH):
-        try:
-            with open(BASELINE_PATH, "r", encoding="utf-8") as f:
-                DAILY_BASE = json.load(f)
-        except:
-            DAILY_BASE = {}
+BASELINE_RETENTION_WEEKS = int(os.environ.get("BASELINE_RETENTION_WEEKS", "8"))
+BASELINE_FLUSH_SECONDS = int(os.environ.get("BASELINE_FLUSH_SECONDS", "60"))
+
+class BaselineStore:
+    """
+    🔹 الـ baseline في الذاكرة هو المرجع: يُقرأ من القرص مرة واحدة، والكتابة على دفعات
+    (flush للـ dirty فقط، atomic عبر ملف مؤقت)، مع حذف الـ expiries المنتهية والأسابيع الأقدم
+    من BASELINE_RETENTION_WEEKS. فهرس week → expiries يجعل فحص التدفق الأسبوعي O(1).
+    """
+    def __init__(self, path):
+        self.path = path
+        self._data = {}      # symbol → expiry → week_key → point
+        self._weeks = {}     # symbol → week_key → [expiries بترتيب الإدخال]
+        self._lock = threading.Lock()   # التحديث المتوازي يكتب الـ baseline من عدة threads
+        self._loaded = False
+        self._dirty = False
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            data = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                except Exception as e:
+                    print(f"[WARN] baseline.json unreadable ({e}) → starting empty")
+                    data = {}
+            self._data = data if isinstance(data, dict) else {}
+            self._dirty = self._prune_locked(dt.date.today())
+            self._reindex_locked()
+            self._loaded = True
+
+    def _reindex_locked(self):
+        self._weeks = {}
+        for sym, expiries in self._data.items():
+            weeks = self._weeks[sym] = {}
+            for expiry, points in expiries.items():
+                for week_key in points:
+                    weeks.setdefault(week_key, []).append(expiry)
+
+    def _prune_locked(self, today):
+        """يحذف expiries المنتهية والأسابيع خارج نافذة الاحتفاظ → True لو تغيّر شيء."""
+        today_key = today.isoformat()
+        cutoff = (today - dt.timedelta(days=today.weekday(), weeks=BASELINE_RETENTION_WEEKS)).isoformat()
+        changed = False
+        for sym in list(self._data):
+            expiries = self._data[sym]
+            for expiry in list(expiries):
+                points = expiries[expiry]
+                if expiry < today_key:
+                    del expiries[expiry]
+                    changed = True
+                    continue
+                for week_key in [w for w in points if w < cutoff]:
+                    del points[week_key]
+                    changed = True
+                if not points:
+                    del expiries[expiry]
+            if not expiries:
+                del self._data[sym]
+        return changed
+
+    def get(self, symbol, expiry, week_key):
+        self._ensure_loaded()
+        return self._data.get(symbol, {}).get(expiry, {}).get(week_key)
+
+    def set_if_absent(self, symbol, expiry, week_key, point):
+        """يحفظ النقطة لو غير موجودة لهذا الأسبوع (لا إعادة إنشاء) → True لو أُضيفت."""
+        self._ensure_loaded()
+        with self._lock:
+            points = self._data.setdefault(symbol, {}).setdefault(expiry, {})
+            if week_key in points:
+                return False
+            points[week_key] = point
+            self._weeks.setdefault(symbol, {}).setdefault(week_key, []).append(expiry)
+            self._dirty = True
+            return True
+
+    def weekly_points(self, symbol, monday_key, today_key):
+        """أول expiry (بترتيب الإدخال) فيه نقطتا بداية الأسبوع واليوم → (base_mon, base_today) أو None."""
+        self._ensure_loaded()
+        expiries = self._data.get(symbol, {})
+        for expiry in self._weeks.get(symbol, {}).get(monday_key, ()):
+            points = expiries.get(expiry) or {}
+            base_today = points.get(today_key)
+            if base_today:
+                return points[monday_key], base_today
+        return None
 
-def save_baseline():
-    os.makedirs(DATA_PATH, exist_ok=True)
-    with open(BASELINE_PATH, "w", encoding="utf-8") as f:
-        json.dump(DAILY_BASE, f, ensure_ascii=False, indent=2)
+    def flush(self):
+        """💾 يكتب الملف فقط لو توجد تغييرات (مع تنظيف القديم)، عبر ملف مؤقت + os.replace."""
+        if not self._loaded:
+            return False
+        with self._lock:
+            if self._prune_locked(dt.date.today()):
+                self._reindex_locked()
+                self._dirty = True
+            if not self._dirty:
+                return False
+            payload = json.dumps(self._data, ensure_ascii=False, separators=(",", ":"))
+            self._dirty = False
+        try:
+            _ensure_data_dir()
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(payload)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"[WARN] baseline flush failed: {e}")
+            self._dirty = True
+            return False
+        return True
+
+BASELINES = BaselineStore(BASELINE_PATH)
+atexit.register(BASELINES.flush)
+
+def baseline_flusher():
+    """🔁 flush دوري للـ baseline (الدفعات بين دورات التحديث، مثل تحديثات SWR)."""
+    while True:
+        time.sleep(BASELINE_FLUSH_SECONDS)
+        BASELINES.flush()
 
 # ---------- Config thresholds للـ Credit Signal ----------
 MIN_BASE_OI  = 50     # أقل OI إجمالي معقول للقياس
@@ -96,15 +202,153 @@ def _err(msg, http=502, data=None, sym=None):
     return Response(json.dumps(body, ensure_ascii=False),
                     status=http, mimetype="application/json")
 
-def _get(url, params=None):
-    params = params or {}
-    params["apiKey"] = POLY_KEY
-    headers = {"Authorization": f"Bearer {POLY_KEY}"} if POLY_KEY else {}
-    r = requests.get(url, params=params, headers=headers, timeout=30)
+# ---------------------- Polygon HTTP client -----------------------
+# حدود خطة Polygon (طلبات/ثانية + السعة القصوى للـ burst) وإعادة المحاولة
+POLY_RATE_PER_SEC = float(os.environ.get("POLY_RATE_PER_SEC", "20"))
+POLY_BURST        = int(os.environ.get("POLY_BURST", "20"))
+POLY_MAX_RETRIES  = int(os.environ.get("POLY_MAX_RETRIES", "5"))
+POLY_BACKOFF_BASE = 0.5   # ثواني، تتضاعف مع كل محاولة
+POLY_BACKOFF_MAX  = 30.0
+POLY_POOL_SIZE    = int(os.environ.get("POLY_POOL_SIZE", "32"))
+RETRY_STATUSES    = {429, 500, 502, 503, 504}
+
+class PolygonError(Exception):
+    """فشل نهائي في طلب Polygon بعد استنفاد المحاولات."""
+    def __init__(self, url, status, body=None):
+        super().__init__(f"Polygon request failed ({status}): {url}")
+        self.url, self.status, self.body = url, status, body
+
+class ChainTruncated(PolygonError):
+    """الـ cursor لم ينتهِ خلال MAX_PAGES صفحة — السلسلة ناقصة فلا تُنشر."""
+    def __init__(self, url, pages):
+        Exception.__init__(self, f"Polygon pagination truncated after {pages} pages: {url}")
+        self.url, self.status, self.body = url, None, None
+
+class TokenBucket:
+    """🔹 محدد معدل بسيط: rate توكن/ثانية بسعة burst (آمن بين الـ threads)."""
+    def __init__(self, rate, burst):
+        self.rate = max(float(rate), 0.001)
+        self.capacity = max(float(burst), 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def _retry_after_seconds(value):
+    """Retry-After إما عدد ثواني أو تاريخ HTTP."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
     try:
-        return r.status_code, r.json()
+        when = parsedate_to_datetime(value)
+        return max((when - dt.datetime.now(when.tzinfo)).total_seconds(), 0.0)
     except Exception:
-        return r.status_code, {"error": "Invalid JSON"}
+        return None
+
+def _endpoint_key(url):
+    """يوحّد المسار للإحصائيات (/v3/snapshot/options/AAPL → /v3/snapshot/options/{ticker})."""
+    parts = urlsplit(url).path.rstrip("/").split("/")
+    if parts and parts[-1].isupper():
+        parts[-1] = "{ticker}"
+    return "/".join(parts) or "/"
+
+class PolygonClient:
+    """
+    🔹 عميل Polygon مشترك:
+    - Session واحدة باتصالات keep-alive مجمّعة + ضغط gzip
+    - Token bucket حسب خطة Polygon
+    - إعادة المحاولة مع exponential backoff على 429/5xx (يحترم Retry-After)
+    - عدّادات لكل endpoint: calls / errors / retries / bytes / latency
+    """
+    def __init__(self, api_key, rate=POLY_RATE_PER_SEC, burst=POLY_BURST,
+                 max_retries=POLY_MAX_RETRIES, pool_size=POLY_POOL_SIZE):
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate, burst)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _record(self, endpoint, latency, nbytes, error=False, retry=False):
+        with self._stats_lock:
+            st = self._stats.setdefault(endpoint, {"calls": 0, "errors": 0, "retries": 0, "bytes": 0,
+                                                   "latency_total": 0.0, "latency_max": 0.0})
+            st["calls"] += 1
+            st["bytes"] += nbytes
+            st["latency_total"] += latency
+            st["latency_max"] = max(st["latency_max"], latency)
+            if error: st["errors"] += 1
+            if retry: st["retries"] += 1
+
+    def stats(self):
+        with self._stats_lock:
+            out = {}
+            for ep, st in self._stats.items():
+                out[ep] = dict(st)
+                out[ep]["latency_avg_ms"] = round(1000.0 * st["latency_total"] / st["calls"], 1) if st["calls"] else None
+                out[ep]["latency_max_ms"] = round(1000.0 * st["latency_max"], 1)
+                del out[ep]["latency_total"], out[ep]["latency_max"]
+            return out
+
+    def get(self, url, params=None):
+        """يرجع (status, json) — الـ status غير 200 فقط بعد استنفاد المحاولات."""
+        params = dict(params or {})
+        params["apiKey"] = self.api_key
+        endpoint = _endpoint_key(url)
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            t0 = time.perf_counter()
+            try:
+                r = self.session.get(url, params=params, timeout=30)
+            except requests.RequestException as e:
+                latency = time.perf_counter() - t0
+                retry = attempt < self.max_retries
+                self._record(endpoint, latency, 0, error=True, retry=retry)
+                if not retry:
+                    return 599, {"error": str(e)}
+                delay = min(POLY_BACKOFF_BASE * (2 ** attempt), POLY_BACKOFF_MAX)
+            else:
+                latency = time.perf_counter() - t0
+                nbytes = int(r.headers.get("Content-Length") or len(r.content))
+                retry = r.status_code in RETRY_STATUSES and attempt < self.max_retries
+                self._record(endpoint, latency, nbytes, error=r.status_code != 200, retry=retry)
+                if not retry:
+                    try:
+                        return r.status_code, r.json()
+                    except Exception:
+                        return r.status_code, {"error": "Invalid JSON"}
+                delay = _retry_after_seconds(r.headers.get("Retry-After"))
+                if delay is None:
+                    delay = min(POLY_BACKOFF_BASE * (2 ** attempt), POLY_BACKOFF_MAX)
+                print(f"[WARN] Polygon {r.status_code} on {endpoint} → retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+            time.sleep(delay + random.uniform(0, 0.1 * delay))
+            attempt += 1
+
+POLY = PolygonClient(POLY_KEY)
+
+def _get(url, params=None):
+    return POLY.get(url, params)
 
 # ---------------------- التاريخ -----------------------
 
@@ -144,34 +388,273 @@ def get_next_earnings(symbol):
         print(f"[WARN] get_next_earnings({symbol}): {e}")
         return None
     
+# ---------------------- Compact chain records -----------------------
+_CTYPE_CODES = {"call": 1, "put": -1}
+_NAN = float("nan")
+
+def _num(x):
+    return float(x) if isinstance(x, (int, float)) else _NAN
+
+class OptionChain:
+    """
+    🔹 سلسلة عقود بأعمدة مضغوطة (array.array) بدل قواميس Polygon الخام.
+    نحتفظ فقط بما نستخدمه: expiry / type / strike / OI / IV / gamma / underlying price
+    (~43 بايت للعقد بدل عدة KB للقاموس الخام).
+    """
+    __slots__ = ("expiries", "_exp_codes", "exp", "ctype", "strike", "oi", "iv", "gamma", "uprice")
+
+    def __init__(self):
+        self.expiries   = []   # code → "YYYY-MM-DD"
+        self._exp_codes = {}
+        self.exp    = array("H")
+        self.ctype  = array("b")
+        self.strike = array("d")
+        self.oi     = array("d")
+        self.iv     = array("d")
+        self.gamma  = array("d")
+        self.uprice = array("d")
+
+    def __len__(self):
+        return len(self.exp)
+
+    def _exp_code(self, expiry):
+        code = self._exp_codes.get(expiry)
+        if code is None:
+            code = self._exp_codes[expiry] = len(self.expiries)
+            self.expiries.append(expiry)
+        return code
+
+    def ingest(self, results):
+        """يحوّل صفحة Polygon خام إلى صفوف مضغوطة (الصفحة الخام تُرمى بعدها)."""
+        for r in results:
+            det = r.get("details") or {}
+            self.exp.append(self._exp_code(det.get("expiration_date")))
+            self.ctype.append(_CTYPE_CODES.get(det.get("contract_type"), 0))
+            self.strike.append(_num(det.get("strike_price")))
+            self.oi.append(_num(r.get("open_interest")))
+            self.iv.append(_num(r.get("implied_volatility")))
+            self.gamma.append(_num((r.get("greeks") or {}).get("gamma")))
+            self.uprice.append(_num((r.get("underlying_asset") or {}).get("price")))
+        return self
+
+    def extend(self, other):
+        remap = [self._exp_code(e) for e in other.expiries]
+        self.exp.extend(remap[c] for c in other.exp)
+        for col in ("ctype", "strike", "oi", "iv", "gamma", "uprice"):
+            getattr(self, col).extend(getattr(other, col))
+        return self
+
+class ChainColumns:
+    """
+    🔹 نفس السلسلة كمصفوفات NumPy متوازية (strike / type / OI / gamma / IV / underlying price)
+    — أساس التجميع الـ vectorized بدل حلقات بايثون على العقود.
+    القيم المفقودة = NaN، والنوع: 1 call / -1 put / 0 غير معروف.
+    """
+    __slots__ = ("expiries", "exp", "ctype", "strike", "oi", "iv", "gamma", "uprice")
+    FIELDS = ("exp", "ctype", "strike", "oi", "iv", "gamma", "uprice")
+
+    def __init__(self, expiries, exp, ctype, strike, oi, iv, gamma, uprice):
+        self.expiries = expiries
+        self.exp, self.ctype, self.strike = exp, ctype, strike
+        self.oi, self.iv, self.gamma, self.uprice = oi, iv, gamma, uprice
+
+    @classmethod
+    def from_chain(cls, chain):
+        """بدون نسخ: المصفوفات تشير مباشرة إلى أعمدة OptionChain."""
+        return cls(
+            list(chain.expiries),
+            np.frombuffer(chain.exp, dtype=np.uint16),
+            np.frombuffer(chain.ctype, dtype=np.int8),
+            *(np.frombuffer(getattr(chain, f), dtype=np.float64)
+              for f in ("strike", "oi", "iv", "gamma", "uprice")),
+        )
+
+    def __len__(self):
+        return len(self.exp)
+
+    def take(self, sel):
+        return ChainColumns(self.expiries, *(getattr(self, f)[sel] for f in self.FIELDS))
+
+    def spot(self):
+        """أول سعر أصل موجب (None لو لا يوجد)."""
+        hit = np.flatnonzero(self.uprice > 0)
+        return float(self.uprice[hit[0]]) if len(hit) else None
+
+class ChainIndex:
+    """
+    🔹 فهرس يُبنى مرة واحدة لكل جلب وتستهلكه كل المراحل (التحليل / EM / الإشارات / Flow):
+    - العقود مرتبة (expiry → type → strike) فيصبح كل expiry شريحة متصلة
+    - داخل كل expiry: شريحة calls ثم puts (نفس ترتيب Polygon)، كل منها مرتب حسب السترايك
+    - السعر (spot) محسوب مرة واحدة
+    الشرائح views بدون نسخ → تكلفة التحديث مسح واحد للسلسلة.
+    """
+    __slots__ = ("cols", "spot", "_slices")
+
+    def __init__(self, cols):
+        self.spot = cols.spot()
+        order = np.lexsort((cols.strike, -cols.ctype, cols.exp))
+        self.cols = cols = cols.take(order)
+        self._slices = {}
+        n = len(cols)
+        if not n:
+            return
+        starts = np.r_[0, np.flatnonzero(np.diff(cols.exp)) + 1]
+        stops  = np.r_[starts[1:], n]
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            ctype = -cols.ctype[start:stop]   # تصاعدي: -1 call, 0, 1 put
+            c_end = start + int(np.searchsorted(ctype, -1, side="right"))
+            p_beg = start + int(np.searchsorted(ctype, 1, side="left"))
+            self._slices[cols.expiries[cols.exp[start]]] = (slice(start, stop), slice(start, c_end), slice(p_beg, stop))
+
+    @property
+    def expiries(self):
+        return sorted(e for e in self._slices if e)
+
+    def _view(self, expiry, part):
+        sl = self._slices.get(expiry)
+        return self.cols.take(sl[part] if sl else slice(0, 0))
+
+    def expiry(self, expiry):
+        return self._view(expiry, 0)
+
+    def calls(self, expiry):
+        return self._view(expiry, 1)
+
+    def puts(self, expiry):
+        return self._view(expiry, 2)
+
 # ---------------------- Polygon fetch -----------------------
-def fetch_all(symbol):
-    url = f"{BASE_SNAP}/{symbol.upper()}"
-    cursor, all_rows = None, []
-    for _ in range(10):
-        params = {"limit": 50}
-        if cursor:
-            params["cursor"] = cursor
-        status, j = _get(url, params)
-        if status != 200 or j.get("status") != "OK":
-            break
-        rows = j.get("results") or []
-        all_rows.extend(rows)
-        cursor = j.get("next_url")
-        if not cursor:
-            break
-        if "cursor=" in cursor:
-            cursor = cursor.split("cursor=")[-1]
-        else:
-            cursor = None
-    return all_rows
+STRIKE_BAND           = 0.25   # ±25% حول السعر (نفس فلتر التحليل)
+ATM_PROBE_BAND        = 0.05   # نطاق ضيق حول السعر لاكتشاف الاستحقاقات
+EXPIRY_LOOKAHEAD_DAYS = 62     # يغطي الشهر الأول كاملاً + الأسبوع القادم
+SNAP_PAGE_LIMIT       = 250    # أقصى حجم صفحة في snapshot
+REF_PAGE_LIMIT        = 1000   # أقصى حجم صفحة في reference/contracts
+MAX_PAGES             = 200    # حماية من cursor لا ينتهي
+FETCH_SHARD_WORKERS   = max(1, int(os.environ.get("FETCH_SHARD_WORKERS", "6")))
+_SHARD_POOL = ThreadPoolExecutor(max_workers=FETCH_SHARD_WORKERS, thread_name_prefix="shard")
+
+_PAGE_POOL = ThreadPoolExecutor(max_workers=2 * FETCH_SHARD_WORKERS, thread_name_prefix="page")
+
+def _get_page(url, params):
+    """صفحة واحدة → (next_url, results) — يرفع PolygonError عند الفشل."""
+    status, j = _get(url, params)
+    if status != 200 or j.get("status") != "OK":
+        # ❗ لا نقطع السلسلة بصمت: نرفع خطأ حتى لا تُنشر بيانات ناقصة
+        raise PolygonError(url, status, j)
+    return j.get("next_url"), j.get("results") or []
+
+def _iter_pages(url, params):
+    """
+    يولّد نتائج كل صفحة ويتبع next_url حتى النهاية.
+    الصفحة التالية تُطلب مسبقًا (prefetch) بينما تُعالج الصفحة الحالية.
+    تجاوز MAX_PAGES → ChainTruncated (لا نرجع سلسلة ناقصة بصمت).
+    """
+    pending = _PAGE_POOL.submit(_get_page, url, params)
+    for _ in range(MAX_PAGES):
+        next_url, results = pending.result()
+        pending = _PAGE_POOL.submit(_get_page, next_url, None) if next_url else None
+        yield results
+        if pending is None:
+            return
+    pending.cancel()
+    raise ChainTruncated(url, MAX_PAGES)
+
+def get_spot_price(symbol):
+    """🔹 سعر الأصل من أول عقد في snapshot (طلب واحد صغير)."""
+    status, j = _get(f"{BASE_SNAP}/{symbol.upper()}", {"limit": 1})
+    if status != 200 or j.get("status") != "OK":
+        raise PolygonError(f"{BASE_SNAP}/{symbol.upper()}", status, j)
+    for r in j.get("results") or []:
+        p = (r.get("underlying_asset") or {}).get("price")
+        if isinstance(p, (int, float)) and p > 0:
+            return float(p)
+    return None
+
+def resolve_expiries(symbol, spot):
+    """🔹 كل الاستحقاقات القادمة (ضمن EXPIRY_LOOKAHEAD_DAYS) من عقود Call قريبة من السعر."""
+    today = TODAY()
+    pages = _iter_pages(f"{BASE_REF}/contracts", {
+        "underlying_ticker":   symbol.upper(),
+        "contract_type":       "call",
+        "expired":             "false",
+        "expiration_date.gte": today.isoformat(),
+        "expiration_date.lte": (today + dt.timedelta(days=max(EXPIRY_LOOKAHEAD_DAYS, TERM_HORIZON_DAYS))).isoformat(),
+        "strike_price.gte":    round(spot * (1 - ATM_PROBE_BAND), 2),
+        "strike_price.lte":    round(spot * (1 + ATM_PROBE_BAND), 2),
+        "limit":               REF_PAGE_LIMIT,
+    })
+    return sorted({r.get("expiration_date") for page in pages for r in page if r.get("expiration_date")})
 
-# ------------------------ Expiries --------------------------
-def list_future_expiries(rows):
-    expiries = sorted({
-        r.get("details", {}).get("expiration_date")
-        for r in rows if r.get("details", {}).get("expiration_date")
+def term_expiries(expiries):
+    """الاستحقاقات الإضافية لوضع الـ term structure (ضمن TERM_HORIZON_DAYS)."""
+    if TERM_HORIZON_DAYS <= 0:
+        return []
+    last = (TODAY() + dt.timedelta(days=TERM_HORIZON_DAYS)).isoformat()
+    return [e for e in expiries if e <= last]
+
+def plan_fetch(symbol):
+    """
+    🔹 يحدد ما يجب جلبه قبل أي تحميل كبير:
+    السعر → الاستحقاقات → (الأسبوع الحالي، القادم، الشهري) + حدود السترايك.
+    يرجع None لو تعذّر التخطيط (نرجع للجلب الكامل).
+    """
+    try:
+        spot = get_spot_price(symbol)
+        if spot is None:
+            return None
+        expiries = resolve_expiries(symbol, spot)
+    except PolygonError as e:
+        print(f"[WARN] plan_fetch {symbol} failed ({e}) → full chain fetch")
+        return None
+    if not expiries:
+        return None
+    targets = target_expiries(expiries)
+    strike_lo, strike_hi = strike_bounds(spot)
+    return {
+        "spot": spot,
+        "expiries": expiries,
+        "targets": targets,
+        "shards": sorted({e for e in targets.values() if e} | set(term_expiries(expiries))),
+        "strike_lo": strike_lo,
+        "strike_hi": strike_hi,
+    }
+
+def strike_bounds(spot):
+    """حدود السترايك spot ± STRIKE_BAND (نفسها للجلب المخطط وللجلب الكامل)."""
+    return math.floor(spot * (1 - STRIKE_BAND) * 100) / 100, math.ceil(spot * (1 + STRIKE_BAND) * 100) / 100
+
+def _ingest_pages(url, params):
+    """🔹 Streaming ingest: كل صفحة تُحوّل فورًا إلى OptionChain مضغوط."""
+    chain = OptionChain()
+    for results in _iter_pages(url, params):
+        chain.ingest(results)
+    return chain
+
+def _fetch_shard(symbol, expiry, strike_lo, strike_hi):
+    return _ingest_pages(f"{BASE_SNAP}/{symbol.upper()}", {
+        "expiration_date":  expiry,
+        "strike_price.gte": strike_lo,
+        "strike_price.lte": strike_hi,
+        "limit":            SNAP_PAGE_LIMIT,
     })
+
+def fetch_all(symbol, plan=None):
+    """
+    🔹 يجلب السلسلة كـ OptionChain: مع plan → shard لكل استحقاق (بالتوازي، مع حدود السترايك على السيرفر)،
+    بدون plan → السلسلة كاملة عبر cursor حتى النهاية.
+    """
+    if not plan:
+        return _ingest_pages(f"{BASE_SNAP}/{symbol.upper()}", {"limit": SNAP_PAGE_LIMIT})
+    futures = [_SHARD_POOL.submit(_fetch_shard, symbol, ex, plan["strike_lo"], plan["strike_hi"])
+               for ex in plan["shards"]]
+    chain = OptionChain()
+    for f in futures:
+        chain.extend(f.result())
+    return chain
+
+# ------------------------ Expiries --------------------------
+def list_future_expiries(index):
+    expiries = index.expiries
     today = TODAY().isoformat()
     return [d for d in expiries if d >= today]
 
@@ -206,57 +689,157 @@ def nearest_monthly(expiries):
             last_friday = d
     return last_friday or (month_list[-1] if month_list else expiries[-1])
 
-# ------------- Net Gamma + IV (raw aggregation) -------------
-def _aggregate_gamma_by_strike(rows, price, split_by_price=True):
-    calls_map, puts_map = {}, {}
-    if price is None: return calls_map, puts_map
-
-    low_bound  = price * 0.75
-    high_bound = price * 1.25
-
-    for r in rows:
-        det    = r.get("details", {}) or {}
-        strike = det.get("strike_price")
-        ctype  = det.get("contract_type")
-        oi     = r.get("open_interest")
-        iv     = r.get("implied_volatility")
-        greeks = r.get("greeks") or {}
-        und    = r.get("underlying_asset") or {}
-        uprice = und.get("price", price)
-
-        if not (isinstance(strike, (int, float)) and isinstance(oi, (int, float)) and isinstance(uprice, (int, float))):
-            continue
+def target_expiries(expiries):
+    """🔹 الاستحقاقات المستهدفة: الأسبوع الحالي + القادم + الشهري."""
+    return {
+        "current": nearest_weekly(expiries, next_week=False),
+        "next":    nearest_weekly(expiries, next_week=True),
+        "monthly": nearest_monthly(expiries),
+    }
 
-        if split_by_price and not (low_bound <= float(strike) <= high_bound):
-            continue
+# ------------- Strike metrics (fused aggregation) -------------
+def _group_reduce(cols, price, starts):
+    """
+    يجمع العقود المتجاورة في مجموعات (تبدأ عند starts) في مسح واحد:
+    OI / gamma / GEX / IV لكل مجموعة. الإشارة: +1 call / -1 put.
+    """
+    oi_raw, iv_raw = cols.oi, cols.iv
+    has_oi, has_iv = ~np.isnan(oi_raw), ~np.isnan(iv_raw)
+    oi     = np.where(has_oi, oi_raw, 0.0)
+    gamma  = np.nan_to_num(cols.gamma, nan=0.0)
+    uprice = np.where(np.isnan(cols.uprice), price, cols.uprice)
+    sign   = np.where(cols.ctype == 1, 1.0, -1.0)
+    gex    = sign * gamma * oi * 100.0 * uprice
+
+    red = lambda x: np.add.reduceat(x, starts)
+    return {
+        "n":       np.diff(np.r_[starts, len(oi)]).astype(np.float64),
+        "oi":      red(oi),
+        "gamma":   red(gamma),
+        "gex":     red(gex),
+        "n_oi":    red(has_oi.astype(np.float64)),                       # عقود بـ OI صالح (للـ picks)
+        "iv_pick": red(np.where(has_oi, np.nan_to_num(iv_raw), 0.0)),    # IV=0 للمفقود كما في الـ picks
+        "iv_sum":  red(np.where(has_iv, iv_raw, 0.0)),
+        "n_iv":    red(has_iv.astype(np.float64)),
+    }
+
+def _reduce_side(cols, price):
+    """يجمع عقود جانب واحد (calls أو puts، مرتبة حسب السترايك) لكل سترايك."""
+    cols = cols.take(~np.isnan(cols.strike))
+    if not len(cols):
+        return None
+    starts = np.r_[0, np.flatnonzero(np.diff(cols.strike)) + 1]
+    out = _group_reduce(cols, price, starts)
+    out["strike"] = cols.strike[starts]
+    return out
+
+def _on_grid(grid, side, field):
+    out = np.zeros(len(grid))
+    if side is not None:
+        out[np.searchsorted(grid, side["strike"])] = side[field]
+    return out
+
+def _interp_iv(grid, iv_sum, n_iv, price):
+    """IV عند السعر بالاستيفاء الخطي على السترايكات المرتبة (None لو لا يوجد IV)."""
+    ok = n_iv > 0
+    if price is None or not ok.any():
+        return None
+    return float(np.interp(price, grid[ok], iv_sum[ok] / n_iv[ok]))
 
-        gamma = float(greeks.get("gamma", 0.0) or 0.0)
-        iv_val = float(iv) if isinstance(iv, (int, float)) else 0.0
-        sign = 1.0 if ctype == "call" else -1.0
-        net_gamma = sign * gamma * float(oi) * 100.0 * float(uprice)
-
-        if ctype == "call":
-            if strike not in calls_map:
-                calls_map[strike] = {"net_gamma": 0.0, "iv": iv_val, "count": 0}
-            calls_map[strike]["net_gamma"] += net_gamma
-            calls_map[strike]["iv"] = (calls_map[strike]["iv"] * calls_map[strike]["count"] + iv_val) / (calls_map[strike]["count"] + 1)
-            calls_map[strike]["count"] += 1
-
-        elif ctype == "put":
-            if strike not in puts_map:
-                puts_map[strike] = {"net_gamma": 0.0, "iv": iv_val, "count": 0}
-            puts_map[strike]["net_gamma"] += net_gamma
-            puts_map[strike]["iv"] = (puts_map[strike]["iv"] * puts_map[strike]["count"] + iv_val) / (puts_map[strike]["count"] + 1)
-            puts_map[strike]["count"] += 1
-
-    for d in (calls_map, puts_map):
-        for k in list(d.keys()):
-            v = d[k]
-            d[k] = {"net_gamma": float(v["net_gamma"]), "iv": float(v["iv"])}
-    return calls_map, puts_map
-
-def _pick_top7_directional(calls_map, puts_map):
-    """🔹 استخراج أقوى 7 مستويات Gamma باتجاه السوق مع حماية كاملة من البيانات الفارغة"""
+def _max_pain(grid, call_oi, put_oi):
+    """السترايك الذي يقلّل مجموع قيمة العقود عند الانتهاء — O(n) بالمجاميع التراكمية."""
+    if not len(grid) or not (call_oi.any() or put_oi.any()):
+        return None
+    c_n  = np.r_[0.0, np.cumsum(call_oi)[:-1]]            # calls بسترايك أقل من K
+    c_kn = np.r_[0.0, np.cumsum(call_oi * grid)[:-1]]
+    p_n  = put_oi[::-1].cumsum()[::-1] - put_oi           # puts بسترايك أعلى من K
+    p_kn = (put_oi * grid)[::-1].cumsum()[::-1] - put_oi * grid
+    pain = (grid * c_n - c_kn) + (p_kn - grid * p_n)
+    return float(grid[int(np.argmin(pain))])
+
+class StrikeMetrics:
+    """
+    🔹 كل مقاييس السترايك لاستحقاق واحد في هيكل واحد (مسح واحد لشريحة الفهرس):
+    net GEX، OI للكول/البت (الجدران)، max pain، IV-ATM بالاستيفاء، OI/gamma لكل سترايك (للـ Flow).
+    تقرأ منه الـ picks والـ EM والإشارات والـ Flow.
+    """
+    __slots__ = ("expiry", "price", "strikes", "call_oi", "put_oi", "call_gamma", "put_gamma",
+                 "call_gex", "put_gex", "net_gex", "call_has", "put_has", "call_n", "put_n", "call_iv", "put_iv",
+                 "calls_oi", "puts_oi", "call_wall", "put_wall", "max_pain",
+                 "call_atm_iv", "put_atm_iv", "atm_iv")
+
+    def __init__(self, index, expiry):
+        self.expiry, self.price = expiry, index.spot
+        price = self.price if self.price is not None else np.nan
+        calls = _reduce_side(index.calls(expiry), price)
+        puts  = _reduce_side(index.puts(expiry), price)
+        grid = np.union1d(calls["strike"] if calls else [], puts["strike"] if puts else [])
+        self.strikes = grid
+
+        self.call_oi, self.put_oi       = _on_grid(grid, calls, "oi"), _on_grid(grid, puts, "oi")
+        self.call_gamma, self.put_gamma = _on_grid(grid, calls, "gamma"), _on_grid(grid, puts, "gamma")
+        self.call_gex, self.put_gex     = _on_grid(grid, calls, "gex"), _on_grid(grid, puts, "gex")
+        self.net_gex = self.call_gex + self.put_gex
+        self.call_has, self.put_has = _on_grid(grid, calls, "n") > 0, _on_grid(grid, puts, "n") > 0
+        self.call_n, self.put_n = _on_grid(grid, calls, "n_oi"), _on_grid(grid, puts, "n_oi")
+        self.call_iv = np.divide(_on_grid(grid, calls, "iv_pick"), self.call_n,
+                                 out=np.zeros(len(grid)), where=self.call_n > 0)
+        self.put_iv  = np.divide(_on_grid(grid, puts, "iv_pick"), self.put_n,
+                                 out=np.zeros(len(grid)), where=self.put_n > 0)
+
+        self.calls_oi = float(self.call_oi.sum())
+        self.puts_oi  = float(self.put_oi.sum())
+        self.call_wall = float(grid[int(np.argmax(self.call_oi))]) if self.calls_oi > 0 else None
+        self.put_wall  = float(grid[int(np.argmax(self.put_oi))])  if self.puts_oi  > 0 else None
+        self.max_pain  = _max_pain(grid, self.call_oi, self.put_oi)
+
+        self.call_atm_iv = _interp_iv(grid, _on_grid(grid, calls, "iv_sum"), _on_grid(grid, calls, "n_iv"), self.price)
+        self.put_atm_iv  = _interp_iv(grid, _on_grid(grid, puts, "iv_sum"),  _on_grid(grid, puts, "n_iv"),  self.price)
+        ivs = [v for v in (self.call_atm_iv, self.put_atm_iv) if v is not None]
+        self.atm_iv = sum(ivs) / len(ivs) if ivs else None
+
+    def __len__(self):
+        return len(self.strikes)
+
+    def gamma_maps(self, split_by_price=True):
+        """calls_map / puts_map بنفس شكل التجميع القديم: {strike: {"net_gamma", "iv"}}."""
+        calls_map, puts_map = {}, {}
+        if self.price is None:
+            return calls_map, puts_map
+        in_band = np.ones(len(self.strikes), dtype=bool)
+        if split_by_price:
+            in_band = (self.strikes >= self.price * (1 - STRIKE_BAND)) & (self.strikes <= self.price * (1 + STRIKE_BAND))
+        for n, gex, iv, out in ((self.call_n, self.call_gex, self.call_iv, calls_map),
+                                (self.put_n,  self.put_gex,  self.put_iv,  puts_map)):
+            m = in_band & (n > 0)
+            for k, g, v in zip(self.strikes[m].tolist(), gex[m].tolist(), iv[m].tolist()):
+                out[k] = {"net_gamma": g, "iv": v}
+        return calls_map, puts_map
+
+    def levels(self):
+        """ملخص JSON: الجدران + max pain + IV-ATM."""
+        return {"call_wall": self.call_wall, "put_wall": self.put_wall, "max_pain": self.max_pain,
+                "atm_iv": self.atm_iv, "calls_oi": self.calls_oi, "puts_oi": self.puts_oi}
+
+def aggregate_strikes(index, expiries):
+    """🔹 StrikeMetrics لكل expiry مطلوب (يتجاهل المكرر والفارغ)."""
+    out = {}
+    for ex in expiries:
+        if ex and ex not in out and len(index.expiry(ex)):
+            out[ex] = StrikeMetrics(index, ex)
+    return out
+
+# ------------- Top-k level selection -------------
+LEVELS_K            = int(os.environ.get("LEVELS_K", "7"))             # عدد المستويات لكل expiry
+LEVELS_MIN_STRENGTH = float(os.environ.get("LEVELS_MIN_STRENGTH", "0.2"))  # تجاهل < 20% من أقصى |net_gamma|
+LEVELS_SPLIT        = (3, 3)                                           # (أقوى موجب، أقوى سالب) + الأقوى مطلقًا
+
+def select_levels(calls_map, puts_map, k=LEVELS_K, min_strength=LEVELS_MIN_STRENGTH, split=LEVELS_SPLIT):
+    """
+    🔹 استخراج أقوى k مستويات Gamma باتجاه السوق:
+    أقوى split[0] موجب + الأقوى مطلقًا + أقوى split[1] سالب، ثم تعويض بالأقوى المتبقي حتى k.
+    اختيار جزئي بالـ heap بدل الترتيب الكامل؛ مع k=7 النتيجة مطابقة للنسخة القديمة.
+    """
     all_items = []
 
     # 🧩 تجميع جميع القيم من calls و puts
@@ -273,33 +856,21 @@ def _pick_top7_directional(calls_map, puts_map):
 
     # 🧠 حماية من الحالة الفارغة
     if not all_items:
-        print("[WARN] _pick_top7_directional: empty gamma data, skipping symbol")
+        print("[WARN] select_levels: empty gamma data, skipping symbol")
         return []
 
-    # 🔹 حساب أقصى قيمة مطلقة بأمان
-    try:
-        max_abs = max(abs(x[1]) for x in all_items) or 1.0
-    except ValueError:
-        print("[WARN] _pick_top7_directional: failed to compute max_abs, skipping")
-        return []
+    # 🔹 أقوى مستوى مطلقًا (أول ظهور) + أقصى قيمة في مسح واحد
+    strongest_i = max(range(len(all_items)), key=lambda i: abs(all_items[i][1]))
+    max_abs = abs(all_items[strongest_i][1]) or 1.0
 
     # 📊 فلترة المستويات الضعيفة
-    all_items = [x for x in all_items if abs(x[1]) >= 0.2 * max_abs]
-
-    pos = [t for t in all_items if t[1] > 0]
-    neg = [t for t in all_items if t[1] < 0]
+    kept = [i for i, x in enumerate(all_items) if abs(x[1]) >= min_strength * max_abs]
+    strongest = all_items[strongest_i] if kept else (0.0, 0.0, 0.0)
+    items = [all_items[i] for i in kept]
 
-    pos_sorted = sorted(pos, key=lambda x: x[1], reverse=True)
-    neg_sorted = sorted(neg, key=lambda x: x[1])
-
-    top_pos = pos_sorted[:3]
-    top_neg = neg_sorted[:3]
-
-    # 🧩 أقوى مستوى مطلقًا (مع حماية إضافية)
-    try:
-        strongest = max(all_items, key=lambda x: abs(x[1]))
-    except ValueError:
-        strongest = (0.0, 0.0, 0.0)
+    n_pos, n_neg = split
+    top_pos = heapq.nlargest(n_pos, (t for t in items if t[1] > 0), key=lambda x: x[1])
+    top_neg = heapq.nsmallest(n_neg, (t for t in items if t[1] < 0), key=lambda x: x[1])
 
     # 🧠 دمج النتائج بدون تكرار
     sel, seen = [], set()
@@ -315,30 +886,75 @@ def _pick_top7_directional(calls_map, puts_map):
     _add_unique([strongest])
     _add_unique(top_neg)
 
-    # 💪 تعويض لو أقل من 7 عناصر
-    if len(sel) < 7:
-        remaining = [x for x in all_items if (round(x[0], 6), round(x[1], 6)) not in seen]
-        remaining_sorted = sorted(remaining, key=lambda x: abs(x[1]), reverse=True)
-        for x in remaining_sorted:
-            if len(sel) >= 7:
-                break
-            _add_unique([x])
+    # 💪 تعويض لو أقل من k عناصر (heap كسول: نسحب فقط ما نحتاجه)
+    if len(sel) < k:
+        remaining = [(-abs(x[1]), i, x) for i, x in enumerate(items)
+                     if (round(x[0], 6), round(x[1], 6)) not in seen]
+        heapq.heapify(remaining)
+        while remaining and len(sel) < k:
+            _add_unique([heapq.heappop(remaining)[2]])
 
-    return sorted(sel, key=lambda x: x[0])[:7]
+    return sorted(sel, key=lambda x: x[0])[:k]
 
 # ----------------- Net Gamma + IV analysis -----------------
-def analyze_gamma_iv_v51(rows, expiry, split_by_price=True):
-    rows = [r for r in rows if r.get("details", {}).get("expiration_date") == expiry]
-    if not rows: return None, []
-    price = None
-    for r in rows:
-        p = r.get("underlying_asset", {}).get("price")
-        if isinstance(p, (int, float)) and p > 0:
-            price = float(p); break
-    if price is None: return None, []
-    calls_map, puts_map = _aggregate_gamma_by_strike(rows, price, split_by_price=split_by_price)
-    picks = _pick_top7_directional(calls_map, puts_map)
-    return price, picks
+def analyze_gamma_iv_v51(metrics, split_by_price=True):
+    if metrics is None or metrics.price is None: return None, []
+    calls_map, puts_map = metrics.gamma_maps(split_by_price=split_by_price)
+    picks = select_levels(calls_map, puts_map)
+    return metrics.price, picks
+
+# ----------------- Gamma term structure -----------------
+# 0 = فقط الاستحقاقات المستهدفة؛ >0 = كل الاستحقاقات حتى هذا الأفق (تُجلب أيضًا)
+TERM_HORIZON_DAYS = int(os.environ.get("TERM_HORIZON_DAYS", "0"))
+
+def compute_term_structure(index, horizon_days=TERM_HORIZON_DAYS):
+    """
+    🔹 picks + مجاميع net gamma لكل expiry حتى الأفق في تجميع واحد على كامل الفهرس
+    (مجموعات expiry → type → strike المتجاورة) بدل تحليل كل expiry على حدة.
+    """
+    price, cols = index.spot, index.cols
+    if price is None or not len(cols):
+        return []
+    today = TODAY()
+    last = (today + dt.timedelta(days=horizon_days)).isoformat() if horizon_days > 0 else None
+    wanted = [i for i, e in enumerate(cols.expiries)
+              if e and e >= today.isoformat() and (last is None or e <= last)]
+    cols = cols.take(np.isin(cols.exp, wanted) & ~np.isnan(cols.strike) & (cols.ctype != 0))
+    if not len(cols):
+        return []
+
+    # حدود المجموعات: أي تغيّر في expiry أو النوع أو السترايك
+    brk = (np.diff(cols.exp) != 0) | (np.diff(cols.ctype) != 0) | (np.diff(cols.strike) != 0)
+    starts = np.r_[0, np.flatnonzero(brk) + 1]
+    g = _group_reduce(cols, price, starts)
+    g_exp, g_type, g_strike = cols.exp[starts], cols.ctype[starts], cols.strike[starts]
+    g_iv = np.divide(g["iv_pick"], g["n_oi"], out=np.zeros(len(starts)), where=g["n_oi"] > 0)
+    pick_ok = (g["n_oi"] > 0) & (g_strike >= price * (1 - STRIKE_BAND)) & (g_strike <= price * (1 + STRIKE_BAND))
+
+    out = []
+    e_starts = np.r_[0, np.flatnonzero(np.diff(g_exp)) + 1]
+    e_stops  = np.r_[e_starts[1:], len(starts)]
+    for a, b in zip(e_starts.tolist(), e_stops.tolist()):
+        expiry = cols.expiries[g_exp[a]]
+        maps = {1: {}, -1: {}}
+        for t, k, gx, iv in zip(g_type[a:b][pick_ok[a:b]].tolist(), g_strike[a:b][pick_ok[a:b]].tolist(),
+                                g["gex"][a:b][pick_ok[a:b]].tolist(), g_iv[a:b][pick_ok[a:b]].tolist()):
+            maps[t][k] = {"net_gamma": gx, "iv": iv}
+        is_call = g_type[a:b] == 1
+        gex, oi = g["gex"][a:b], g["oi"][a:b]
+        y, m, d = map(int, expiry.split("-"))
+        out.append({
+            "expiry":   expiry,
+            "days":     (dt.date(y, m, d) - today).days,
+            "picks":    select_levels(maps[1], maps[-1]),
+            "call_gex": float(gex[is_call].sum()),
+            "put_gex":  float(gex[~is_call].sum()),
+            "net_gex":  float(gex.sum()),
+            "calls_oi": float(oi[is_call].sum()),
+            "puts_oi":  float(oi[~is_call].sum()),
+        })
+    out.sort(key=lambda x: x["expiry"])
+    return out
 
 # -------------------- Pine normalization -------------------
 def normalize_for_pine_v51(picks):
@@ -365,28 +981,11 @@ def arr_or_empty_int(arr):
     return f"array.from({txt})" if txt else "array.new_int()"
 
 # -------------------- Expected Move (EM) -------------------
-def compute_weekly_em(rows, weekly_expiry):
-    if not weekly_expiry: return None, None, None
-    price = None
-    for r in rows:
-        p = r.get("underlying_asset", {}).get("price")
-        if isinstance(p, (int, float)) and p > 0:
-            price = float(p); break
+def compute_weekly_em(metrics, weekly_expiry):
+    if not weekly_expiry or metrics is None: return None, None, None
+    price = metrics.price
     if price is None: return None, None, None
-    wk_rows = [r for r in rows if r.get("details", {}).get("expiration_date") == weekly_expiry]
-    if not wk_rows: return price, None, None
-    calls = [r for r in wk_rows if r.get("details", {}).get("contract_type") == "call"]
-    puts  = [r for r in wk_rows if r.get("details", {}).get("contract_type") == "put"]
-    def closest_iv(side_rows):
-        best, best_diff = None, 1e18
-        for r in side_rows:
-            strike = r.get("details", {}).get("strike_price")
-            iv     = r.get("implied_volatility")
-            if isinstance(strike, (int,float)) and isinstance(iv, (int,float)):
-                diff = abs(float(strike) - price)
-                if diff < best_diff: best_diff, best = diff, float(iv)
-        return best
-    c_iv, p_iv = closest_iv(calls), closest_iv(puts)
+    c_iv, p_iv = metrics.call_atm_iv, metrics.put_atm_iv
     if c_iv is None and p_iv is None: return price, None, None
     iv_annual = c_iv if p_iv is None else p_iv if c_iv is None else (c_iv + p_iv)/2.0
     y, m, d = map(int, weekly_expiry.split("-")); exp_date = dt.date(y, m, d)
@@ -408,34 +1007,13 @@ def _dynamic_thresholds(total_oi):
         return 0.25, 0.25, 0.09  # ضعيفة السيولة أو قليلة العقود
 
 # ===================== ΔOI + ΔIV SIGNALS ====================
-def _aggregate_oi_iv(rows, expiry, ref_price=None):
+def _aggregate_oi_iv(metrics, ref_price=None):
     """
-    ترجع مجموع OI للكول والبت + IV-ATM تقريبي (أقرب سترايك للسعر).
+    ترجع مجموع OI للكول والبت + IV-ATM (استيفاء عند السعر).
     """
-    rows = [r for r in rows if r.get("details", {}).get("expiration_date") == expiry]
-    if not rows: return None
-    price = ref_price
-    if price is None:
-        for r in rows:
-            p = r.get("underlying_asset", {}).get("price")
-            if isinstance(p, (int, float)) and p > 0:
-                price = float(p); break
-    calls_oi = 0.0; puts_oi = 0.0
-    iv_atm = None; best_diff = 1e18
-    for r in rows:
-        det = r.get("details", {}) or {}
-        strike = det.get("strike_price")
-        ctype  = det.get("contract_type")
-        oi     = r.get("open_interest")
-        iv     = r.get("implied_volatility")
-        if isinstance(oi, (int,float)):
-            if ctype == "call": calls_oi += float(oi)
-            elif ctype == "put": puts_oi += float(oi)
-        if isinstance(strike, (int,float)) and isinstance(iv, (int,float)) and isinstance(price, (int,float)):
-            diff = abs(float(strike) - float(price))
-            if diff < best_diff:
-                best_diff = diff; iv_atm = float(iv)
-    return {"calls": calls_oi, "puts": puts_oi, "iv_atm": iv_atm, "price": price}
+    if metrics is None: return None
+    price = ref_price if ref_price is not None else metrics.price
+    return {"calls": metrics.calls_oi, "puts": metrics.puts_oi, "iv_atm": metrics.atm_iv, "price": price}
 
 def _get_baseline(symbol, expiry):
     """🔹 يرجع baseline ثابت لأسبوع كامل (يبدأ من الاثنين)"""
@@ -444,29 +1022,23 @@ def _get_baseline(symbol, expiry):
     monday = today - dt.timedelta(days=today.weekday())
     week_key = monday.isoformat()
 
-    sym_map = DAILY_BASE.get(symbol, {}).get(expiry, {})
-    return sym_map.get(week_key)
+    return BASELINES.get(symbol, expiry, week_key)
 
 
 def _set_baseline(symbol, expiry, agg):
     """🔹 يحفظ baseline مرة واحدة في بداية الأسبوع"""
-    DAILY_BASE.setdefault(symbol, {})
-    DAILY_BASE[symbol].setdefault(expiry, {})
-
     # 🔸 المفتاح الأسبوعي (أول يوم في الأسبوع)
     today = dt.date.today()
     monday = today - dt.timedelta(days=today.weekday())
     week_key = monday.isoformat()
 
-    # لو baseline محفوظ لهذا الأسبوع لا تعيد إنشاءه
-    if week_key not in DAILY_BASE[symbol][expiry]:
-        DAILY_BASE[symbol][expiry][week_key] = {
-            "timestamp": dt.datetime.now().strftime("%Y-%m-%dT%H:%M"),
-            "calls": float(agg["calls"] or 0.0),
-            "puts":  float(agg["puts"]  or 0.0),
-            "iv_atm": float(agg["iv_atm"] or 0.0)
-        }
-        save_baseline()
+    # لو baseline محفوظ لهذا الأسبوع لا تعيد إنشاءه (الحفظ على القرص يتم على دفعات)
+    BASELINES.set_if_absent(symbol, expiry, week_key, {
+        "timestamp": dt.datetime.now().strftime("%Y-%m-%dT%H:%M"),
+        "calls": float(agg["calls"] or 0.0),
+        "puts":  float(agg["puts"]  or 0.0),
+        "iv_atm": float(agg["iv_atm"] or 0.0)
+    })
 
 
 def _detect_credit_signal(today_agg, base_agg):
@@ -507,91 +1079,622 @@ def _detect_credit_signal(today_agg, base_agg):
         "explain":   "rules-v1"
     }
 # ---------------------- Flow Tracking (ΔOI + ΔGamma) ----------------------
-def track_flow(symbol, rows, prev_data):
+def build_flow_map(metrics):
+    """🔹 لقطة OI + Gamma الحالية من StrikeMetrics كـ FlowFrame مرتبة بالمفتاح (None لو لا يوجد سعر)."""
+    if not metrics or all(m.price is None for m in metrics.values()):
+        return None
+    keys, oi, gamma = [], [], []
+    for ex in sorted(metrics):
+        m = metrics[ex]
+        for is_call, side_oi, side_gamma, present in ((1, m.call_oi, m.call_gamma, m.call_has),
+                                                      (0, m.put_oi,  m.put_gamma,  m.put_has)):
+            keys.append(flow_keys(ex, m.strikes[present], is_call))
+            oi.append(side_oi[present])
+            gamma.append(side_gamma[present])
+    keys = np.concatenate(keys)
+    order = np.argsort(keys, kind="stable")
+    return FlowFrame(None, keys[order], np.concatenate(oi)[order], np.concatenate(gamma)[order])
+
+# 🔹 Flow ring buffer: لقطات مضغوطة (bytes) لكل رمز في الذاكرة تغطي أطول نافذة في FLOW_WINDOWS
+#    (مدة مثل 1h / 4h / 2d أو session / week)، وΔOI/Δgamma لكل نافذة بدون أي قراءة من القرص.
+#    اللقطات الأقدم من بداية أطول نافذة تُحذف؛ FLOW_RING_SIZE سقف احتياطي لعدد اللقطات.
+FLOW_RING_SIZE = max(2, int(os.environ.get("FLOW_RING_SIZE", "256")))
+FLOW_WINDOWS = tuple(w.strip() for w in os.environ.get("FLOW_WINDOWS", "1h,4h,session,week").split(",") if w.strip())
+FLOW_RING_PERSIST = os.environ.get("FLOW_RING_PERSIST", "0") == "1"
+FLOW_RING_DIR = f"{DATA_PATH}/flow_ring"
+FLOW_MIN_DOI = 50   # تجاهل تغيرات بسيطة في OI
+_NY = ZoneInfo("America/New_York")
+_SESSION_OPEN = dt.time(9, 30)
+_WINDOW_UNITS = {"m": 60, "h": 3600, "d": 86400}
+
+# مفتاح العقد int64 واحد (الـ bits من الأعلى): expiry ordinal [bit 33+] | strike × 1000 [bits 1–32] | is_call [bit 0]
+#   → الهوية = (expiry, type, strike) بلا تصادم بين الاستحقاقات أو السترايكات الكسرية (2.5 / 0.5)،
+#     لكن ترتيب المصفوفة = (expiry, strike, type): put و call لنفس السترايك متجاوران.
+_FLOW_EXP_SHIFT = 33
+_FLOW_STRIKE_SCALE = 1000
+_FLOW_RING_FORMAT = 3  # يتغير مع تغيّر صيغة المفتاح أو التخزين (الحلقات المحفوظة بصيغة أخرى تُتجاهل)
+
+def flow_keys(expiry, strikes, is_call):
+    base = np.int64(dt.date.fromisoformat(expiry).toordinal()) << _FLOW_EXP_SHIFT
+    return base + (np.round(np.asarray(strikes) * _FLOW_STRIKE_SCALE).astype(np.int64) << 1) + is_call
+
+class FlowFrame:
+    """لقطة Flow مضغوطة: مفاتيح int64 مرتبة (flow_keys) + مصفوفات OI و gamma."""
+    __slots__ = ("ts", "keys", "oi", "gamma")
+
+    def __init__(self, ts, keys, oi, gamma):
+        self.ts, self.keys, self.oi, self.gamma = ts, keys, oi, gamma
+
+    def __len__(self):
+        return len(self.keys)
+
+    def to_bytes(self):
+        """zlib(فروق المفاتيح int64 | OI float32 | gamma float32) — شكل الحلقة في الذاكرة وعلى القرص."""
+        raw = (np.diff(self.keys, prepend=np.int64(0)).astype("<i8").tobytes()
+               + self.oi.astype("<f4").tobytes() + self.gamma.astype("<f4").tobytes())
+        return zlib.compress(raw, 6)
+
+    @classmethod
+    def from_bytes(cls, ts, blob):
+        raw = zlib.decompress(blob)
+        n = len(raw) // 16
+        return cls(ts, np.cumsum(np.frombuffer(raw, dtype="<i8", count=n)),
+                   np.frombuffer(raw, dtype="<f4", count=n, offset=8 * n).astype(np.float64),
+                   np.frombuffer(raw, dtype="<f4", count=n, offset=12 * n).astype(np.float64))
+
+    @staticmethod
+    def pack(blob):
+        """الشكل المخزن في الـ snapshot: base64 للـ bytes."""
+        return base64.b64encode(blob).decode("ascii")
+
+def _session_open(now):
+    """بداية جلسة نيويورك الحالية (أو آخر جلسة في عطلة/قبل الافتتاح) → epoch."""
+    t = dt.datetime.fromtimestamp(now, _NY)
+    day = t.date() if t.time() >= _SESSION_OPEN else t.date() - dt.timedelta(days=1)
+    while day.weekday() >= 5:
+        day -= dt.timedelta(days=1)
+    return dt.datetime.combine(day, _SESSION_OPEN, tzinfo=_NY).timestamp()
+
+def _window_start(name, now):
+    """epoch بداية النافذة: session / week أو مدة مثل 90m / 4h / 2d."""
+    if name == "session":
+        return _session_open(now)
+    if name == "week":
+        day = dt.datetime.fromtimestamp(_session_open(now), _NY).date()
+        return dt.datetime.combine(day - dt.timedelta(days=day.weekday()), _SESSION_OPEN, tzinfo=_NY).timestamp()
+    m = re.fullmatch(r"(\d+)([mhd])", name)
+    if not m:
+        raise ValueError(f"Invalid flow window: {name}")
+    return now - int(m.group(1)) * _WINDOW_UNITS[m.group(2)]
+
+for _w in FLOW_WINDOWS:
+    _window_start(_w, 0.0)  # نرفض FLOW_WINDOWS غير الصالحة عند الإقلاع
+
+def _flow_horizon(now):
+    """أقدم بداية نافذة في FLOW_WINDOWS — ما قبلها لا يلزم الاحتفاظ به."""
+    return min((_window_start(w, now) for w in FLOW_WINDOWS), default=now)
+
+class FlowRing:
+    def __init__(self, size, root=None):
+        self.size, self.root = size, root
+        self._rings = {}     # symbol → deque[(ts, FlowFrame bytes)]
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def _path(self, symbol):
+        return os.path.join(self.root, f"{symbol}.npz")
+
+    def _seed(self, symbol):
+        """أول وصول للرمز: الحلقة المحفوظة (لو مفعّلة)، وإلا لقطات flow من نسخ SnapshotStore حتى أطول نافذة."""
+        if self.root and os.path.exists(self._path(symbol)):
+            try:
+                with np.load(self._path(symbol)) as z:
+                    if "format" not in z.files or int(z["format"]) != _FLOW_RING_FORMAT:
+                        raise ValueError("old ring format")
+                    blobs, bounds = z["blobs"].tobytes(), np.r_[0, np.cumsum(z["sizes"])].tolist()
+                    return [(ts, blobs[a:b]) for ts, a, b in zip(z["ts"].tolist(), bounds[:-1], bounds[1:])]
+            except (OSError, KeyError, ValueError) as e:
+                print(f"[WARN] flow ring for {symbol} unreadable ({e}) → seeding from snapshot")
+        frames, version, horizon = [], float("inf"), _flow_horizon(time.time())
+        try:
+            while len(frames) < self.size:
+                row = STORE.previous(symbol, version)   # من الأحدث للأقدم (SNAPSHOT_KEEP نسخة كحد أقصى)
+                if row is None:
+                    break
+                version, prev = row
+                ts = prev.get("timestamp") or 0.0
+                text = (prev.get("flow") or {}).get("frame")   # الصيغة القديمة (flow dict) لا تُطابق المفاتيح → تُتجاهل
+                if text:
+                    blob = base64.b64decode(text)
+                    FlowFrame.from_bytes(ts, blob)   # تحقق من سلامة اللقطة قبل اعتمادها أساسًا
+                    frames.append((ts, blob))
+                if ts <= horizon:
+                    break   # هذه لقطة الأساس لأطول نافذة
+        except sqlite3.Error as e:
+            print(f"[WARN] prev snapshot lookup failed for {symbol}: {e}")
+        except (ValueError, zlib.error) as e:
+            print(f"[WARN] stored flow frame for {symbol} unreadable: {e}")
+        frames.reverse()
+        return frames
+
+    def _ring(self, symbol):
+        ring = self._rings.get(symbol)
+        if ring is None:
+            with self._lock:
+                ring = self._rings.get(symbol)
+                if ring is None:
+                    ring = self._rings[symbol] = deque(self._seed(symbol), maxlen=self.size)
+        return ring
+
+    def last(self, symbol):
+        ring = self._ring(symbol)
+        return FlowFrame.from_bytes(*ring[-1]) if ring else None
+
+    def push(self, symbol, ts, blob):
+        """يضيف لقطة (bytes) ويحذف ما قبل بداية أطول نافذة (مع إبقاء لقطة الأساس لها)."""
+        ring = self._ring(symbol)
+        ring.append((ts, blob))
+        horizon = _flow_horizon(ts)
+        while len(ring) > 2 and ring[1][0] <= horizon:
+            ring.popleft()
+        self._dirty.add(symbol)
+
+    def base(self, symbol, start):
+        """أحدث لقطة عند/قبل start؛ لو الحلقة لا تغطي النافذة → أقدم لقطة (partial=True)."""
+        ring = self._ring(symbol)
+        for ts, blob in reversed(ring):
+            if ts <= start:
+                return FlowFrame.from_bytes(ts, blob), False
+        return (FlowFrame.from_bytes(*ring[0]), True) if ring else (None, True)
+
+    def save(self):
+        """💾 يحفظ حلقات الرموز التي تغيّرت (لو FLOW_RING_PERSIST)."""
+        if not self.root:
+            return
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        if not dirty:
+            return
+        _ensure_data_dir()
+        os.makedirs(self.root, exist_ok=True)
+        for symbol in dirty:
+            ring = list(self._rings.get(symbol) or ())
+            tmp = self._path(symbol) + ".tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    np.savez(f, format=np.array(_FLOW_RING_FORMAT), ts=np.array([ts for ts, _ in ring], dtype=np.float64),
+                             sizes=np.array([len(b) for _, b in ring], dtype=np.int64),
+                             blobs=np.frombuffer(b"".join(b for _, b in ring), dtype=np.uint8))
+                os.replace(tmp, self._path(symbol))
+            except OSError as e:
+                print(f"[WARN] flow ring save failed for {symbol}: {e}")
+
+FLOW_RING = FlowRing(FLOW_RING_SIZE, FLOW_RING_DIR if FLOW_RING_PERSIST else None)
+atexit.register(FLOW_RING.save)
+
+def _flow_delta(cur, base):
+    """
+    ΔOI / Δgamma لكل عقد في cur مقابل base: merge-join على المفاتيح المرتبة (searchsorted)،
+    والعقد الغائب في base = 0 (عقد جديد). العقود التي اختفت (استحقاق انتهى) لا تُحسب.
     """
-    🔍 يحلل تحركات السيولة بين التحديث الحالي والسابق.
-    prev_data = بيانات آخر Snapshot من data/all.json
+    if base is None or not len(base.keys):
+        return cur.oi.copy(), cur.gamma.copy()
+    pos = np.minimum(np.searchsorted(base.keys, cur.keys), len(base.keys) - 1)
+    hit = base.keys[pos] == cur.keys
+    return (cur.oi - np.where(hit, base.oi[pos], 0.0),
+            cur.gamma - np.where(hit, base.gamma[pos], 0.0))
+
+def _flow_summary(cur, base):
+    d_oi, d_gm = _flow_delta(cur, base)
+    d_oi = np.round(d_oi, 2)
+    call = (cur.keys & 1) == 1
+    up = (np.abs(d_oi) > FLOW_MIN_DOI) & (d_oi > 0)
+    puts_up, calls_up = float(d_oi[up & ~call].sum()), float(d_oi[up & call].sum())
+
+    flow_signal = "⚪ محايد"
+    if puts_up > calls_up * 1.3:
+        flow_signal = "📈 تدفق سيولة إلى عقود PUT (دعم السوق)"
+    elif calls_up > puts_up * 1.3:
+        flow_signal = "📉 تدفق سيولة إلى عقود CALL (ضغط بيعي)"
+    return {"flow_signal": flow_signal, "puts_up": puts_up, "calls_up": calls_up,
+            "d_oi_calls": float(d_oi[call].sum()), "d_oi_puts": float(d_oi[~call].sum()),
+            "d_gamma": round(float(d_gm.sum()), 6)}
+
+def track_flow(symbol, frame, now=None, ring=FLOW_RING):
+    """
+    🔍 يحلل تحركات السيولة بين التحديث الحالي واللقطات السابقة في الـ ring buffer.
+    frame = لقطة OI + Gamma الحالية (build_flow_map)
+    النتيجة: الإشارة مقابل آخر لقطة + windows لكل نافذة في FLOW_WINDOWS + اللقطة مضغوطة (frame).
     """
     try:
-        price = None
-        for r in rows:
-            p = r.get("underlying_asset", {}).get("price")
-            if isinstance(p, (int, float)):
-                price = float(p)
-                break
-
-        if price is None:
+        if frame is None:
             return {"status": "no-price"}
-
-        # 🔹 بناء خريطة OI + Gamma الحالية
-        flow_map = {}
-        for r in rows:
-            det = r.get("details", {})
-            strike = det.get("strike_price")
-            ctype = det.get("contract_type")
-            oi = r.get("open_interest") or 0
-            gamma = (r.get("greeks") or {}).get("gamma", 0)
-            if not isinstance(strike, (int, float)):
-                continue
-            key = f"{ctype}_{int(strike)}"
-            flow_map[key] = {"oi": oi, "gamma": gamma}
-
-        # 🔹 مقارنة مع البيانات السابقة
-        changes = []
-        old = prev_data.get("flow", {}) if isinstance(prev_data, dict) else {}
-        for key, v in flow_map.items():
-            old_v = old.get(key, {"oi": 0, "gamma": 0})
-            d_oi = v["oi"] - old_v.get("oi", 0)
-            d_gm = v["gamma"] - old_v.get("gamma", 0)
-            if abs(d_oi) > 50:  # تجاهل تغيرات بسيطة
-                changes.append({"strike": key, "d_oi": round(d_oi, 2), "d_gamma": round(d_gm, 6)})
-
-        # 🔹 تحليل الاتجاه
-        puts_up = sum(c["d_oi"] for c in changes if "put" in c["strike"].lower() and c["d_oi"] > 0)
-        calls_up = sum(c["d_oi"] for c in changes if "call" in c["strike"].lower() and c["d_oi"] > 0)
-
-        flow_signal = "⚪ محايد"
-        if puts_up > calls_up * 1.3:
-            flow_signal = "📈 تدفق سيولة إلى عقود PUT (دعم السوق)"
-        elif calls_up > puts_up * 1.3:
-            flow_signal = "📉 تدفق سيولة إلى عقود CALL (ضغط بيعي)"
+        now = time.time() if now is None else now
+        blob = FlowFrame(now, frame.keys, frame.oi, frame.gamma).to_bytes()
+        cur = FlowFrame.from_bytes(now, blob)   # نفس دقة اللقطات المخزنة (float32) على طرفي الفرق
+
+        # 🔹 مقارنة مع اللقطة السابقة
+        out = _flow_summary(cur, ring.last(symbol))
+        windows = {}
+        for name in FLOW_WINDOWS:
+            start = _window_start(name, now)
+            base, partial = ring.base(symbol, start)
+            w = _flow_summary(cur, base)
+            w.update({"since": base.ts if base else None, "partial": partial})
+            windows[name] = w
+        ring.push(symbol, now, blob)
 
         return {
-            "flow_signal": flow_signal,
-            "puts_up": puts_up,
-            "calls_up": calls_up,
-            "flow": flow_map
+            "flow_signal": out["flow_signal"],
+            "puts_up": out["puts_up"],
+            "calls_up": out["calls_up"],
+            "windows": windows,
+            "contracts": len(cur),
+            "frame": FlowFrame.pack(blob)
         }
     except Exception as e:
         return {"error": str(e)}
 
-# -------------------- Update + Cache -----------------------
-def update_symbol_data(symbol):
-    rows = fetch_all(symbol)
-    expiries = list_future_expiries(rows)
-    if not expiries:
+# -------------------- Compute stage -----------------------
+# inline = داخل نفس العملية | pool = Process Pool دائمًا | auto = pool فقط للسلاسل الكبيرة
+COMPUTE_MODE = os.environ.get("COMPUTE_MODE", "inline").lower()
+COMPUTE_WORKERS = max(1, int(os.environ.get("COMPUTE_WORKERS", "1")))
+COMPUTE_POOL_MIN_CONTRACTS = int(os.environ.get("COMPUTE_POOL_MIN_CONTRACTS", "20000"))
+_COMPUTE_SIZE_BUCKETS = (5_000, 20_000, 50_000, 100_000)
+
+def compute_chain(cols, targets=None, horizon_days=TERM_HORIZON_DAYS):
+    """
+    🔹 مرحلة الحساب (CPU فقط، بدون حالة ولا I/O):
+    فهرس → مقاييس السترايك → picks / EM / OI-IV / Flow map / Term.
+    targets=None → تُستنتج من السلسلة نفسها (الجلب الكامل)، والسلسلة تُقص لنفس حدود السترايك
+    التي يطلبها الجلب المخطط — فلا تتغير الجدران/OI/max pain/Flow حسب طريقة الجلب.
+    """
+    if targets is None:
+        spot = cols.spot()
+        if spot is not None:
+            lo, hi = strike_bounds(spot)
+            cols = cols.take((cols.strike >= lo) & (cols.strike <= hi))
+    index = ChainIndex(cols)
+    if targets is None:
+        expiries = list_future_expiries(index)
+        if not expiries:
+            return None
+        targets = target_expiries(expiries)
+    exp_curr, exp_next, exp_m = targets["current"], targets["next"], targets["monthly"]
+
+    # 🔹 كل مقاييس السترايك لكل expiry مستهدف (مسح واحد لكل شريحة)
+    metrics = aggregate_strikes(index, (exp_curr, exp_next, exp_m))
+
+    out = {}
+    for tag, ex in (("weekly_current", exp_curr), ("weekly_next", exp_next), ("monthly", exp_m)):
+        price, picks = analyze_gamma_iv_v51(metrics.get(ex), split_by_price=True)
+        out[tag] = {"expiry": ex, "price": price, "picks": picks,
+                    "levels": metrics[ex].levels() if ex in metrics else None}
+
+    # EM + ΔOI/ΔIV aggregates per weekly expiry
+    out["em"], out["agg"] = {}, {}
+    for tag, key, ex in (("current", "weekly_current", exp_curr), ("next", "weekly_next", exp_next)):
+        em_price, em_iv, em_value = compute_weekly_em(metrics.get(ex), ex)
+        out["em"][tag] = {"price": em_price, "iv_annual": em_iv, "weekly_em": em_value}
+        out["agg"][tag] = _aggregate_oi_iv(metrics.get(ex), ref_price=out[key]["price"]) if ex else None
+
+    out["flow_map"] = build_flow_map(metrics)
+    out["term"] = compute_term_structure(index, horizon_days)
+    out["history"] = history_columns(metrics)
+    return out
+
+# ---- shared-memory handoff: أعمدة السلسلة في كتلة واحدة بدل قوائم قواميس مُسلسلة ----
+_SHM_LAYOUT = (("strike", np.float64), ("oi", np.float64), ("iv", np.float64), ("gamma", np.float64),
+               ("uprice", np.float64), ("exp", np.uint16), ("ctype", np.int8))
+
+def _shm_views(buf, n):
+    views, off = {}, 0
+    for name, dtype in _SHM_LAYOUT:
+        views[name] = np.ndarray((n,), dtype=dtype, buffer=buf, offset=off)
+        off += n * np.dtype(dtype).itemsize
+    return views
+
+def _shm_pack(cols):
+    n = len(cols)
+    size = sum(n * np.dtype(d).itemsize for _, d in _SHM_LAYOUT)
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    views = _shm_views(shm.buf, n)
+    for name, _ in _SHM_LAYOUT:
+        views[name][:] = getattr(cols, name)
+    del views
+    return shm
+
+def _compute_worker(shm_name, n, expiries, targets, horizon_days):
+    """يعمل داخل عملية الـ pool: يقرأ الأعمدة من الذاكرة المشتركة ويرجع النتيجة + زمن الحساب."""
+    t0 = time.perf_counter()
+    shm = shared_memory.SharedMemory(name=shm_name)   # العملية الرئيسية هي المالكة (unlink)
+    try:
+        v = _shm_views(shm.buf, n)
+        cols = ChainColumns(expiries, v["exp"], v["ctype"], v["strike"], v["oi"], v["iv"], v["gamma"], v["uprice"])
+        del v
+        result = compute_chain(cols, targets, horizon_days)
+        del cols
+    finally:
+        shm.close()
+    return result, time.perf_counter() - t0
+
+_COMPUTE_POOL = None
+_COMPUTE_POOL_LOCK = threading.Lock()
+
+def _compute_pool():
+    global _COMPUTE_POOL
+    with _COMPUTE_POOL_LOCK:
+        if _COMPUTE_POOL is None:
+            _COMPUTE_POOL = ProcessPoolExecutor(max_workers=COMPUTE_WORKERS,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        return _COMPUTE_POOL
+
+def _reset_compute_pool():
+    global _COMPUTE_POOL
+    with _COMPUTE_POOL_LOCK:
+        pool, _COMPUTE_POOL = _COMPUTE_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _compute_in_pool(cols, targets, horizon_days):
+    shm = _shm_pack(cols)
+    try:
+        fut = _compute_pool().submit(_compute_worker, shm.name, len(cols), list(cols.expiries), targets, horizon_days)
+        return fut.result()
+    finally:
+        shm.close()
+        shm.unlink()
+
+# ---- timing: متوسط الزمن لكل وضع وحجم سلسلة لمعرفة نقطة التحوّل ----
+_COMPUTE_STATS = {}
+_COMPUTE_STATS_LOCK = threading.Lock()
+
+def _size_bucket(n):
+    lo = 0
+    for hi in _COMPUTE_SIZE_BUCKETS:
+        if n < hi:
+            return f"{lo}-{hi}"
+        lo = hi
+    return f"{lo}+"
+
+def _record_compute(mode, n, total, worker=None):
+    with _COMPUTE_STATS_LOCK:
+        st = _COMPUTE_STATS.setdefault((mode, _size_bucket(n)), {"runs": 0, "contracts": 0, "total_s": 0.0,
+                                                                 "max_s": 0.0, "worker_s": 0.0})
+        st["runs"] += 1
+        st["contracts"] += n
+        st["total_s"] += total
+        st["max_s"] = max(st["max_s"], total)
+        if worker is not None:
+            st["worker_s"] += worker
+
+def compute_stats():
+    with _COMPUTE_STATS_LOCK:
+        out = []
+        for (mode, bucket), st in sorted(_COMPUTE_STATS.items()):
+            row = {"mode": mode, "contracts": bucket, "runs": st["runs"],
+                   "avg_ms": round(1000.0 * st["total_s"] / st["runs"], 2),
+                   "max_ms": round(1000.0 * st["max_s"], 2),
+                   "avg_contracts": st["contracts"] // st["runs"]}
+            if mode == "pool":
+                # الفرق بين الزمن الكلي وزمن العامل = تكلفة النقل (shared memory + IPC)
+                row["avg_worker_ms"] = round(1000.0 * st["worker_s"] / st["runs"], 2)
+                row["avg_overhead_ms"] = round(row["avg_ms"] - row["avg_worker_ms"], 2)
+            out.append(row)
+        return out
+
+def run_compute(symbol, chain, targets=None, mode=None):
+    """
+    🔹 يشغّل مرحلة الحساب inline أو في Process Pool (حسب COMPUTE_MODE) ويسجل الزمن.
+    عند تعطل الـ pool نرجع للحساب inline.
+    """
+    mode = (mode or COMPUTE_MODE)
+    cols = ChainColumns.from_chain(chain)
+    n = len(cols)
+    use_pool = mode == "pool" or (mode == "auto" and n >= COMPUTE_POOL_MIN_CONTRACTS)
+    t0 = time.perf_counter()
+    if use_pool:
+        try:
+            result, worker_s = _compute_in_pool(cols, targets, TERM_HORIZON_DAYS)
+            took = time.perf_counter() - t0
+            _record_compute("pool", n, took, worker_s)
+            print(f"[Compute] {symbol}: {n} contracts in pool {took * 1000:.1f}ms (worker {worker_s * 1000:.1f}ms)")
+            return result
+        except (BrokenProcessPool, OSError) as e:
+            print(f"[WARN] compute pool failed for {symbol}: {e} → inline")
+            _reset_compute_pool()
+            t0 = time.perf_counter()
+    result = compute_chain(cols, targets, TERM_HORIZON_DAYS)
+    took = time.perf_counter() - t0
+    _record_compute("inline", n, took)
+    print(f"[Compute] {symbol}: {n} contracts inline {took * 1000:.1f}ms")
+    return result
+
+# -------------------- History (gamma profiles) ------------
+# 🔹 سلسلة زمنية على القرص لمقاييس السترايك لكل تحديث: ملف لكل رمز لكل يوم (UTC)، كل تحديث
+#    frame مستقل = header ثابت الحجم + أعمدة مضغوطة بـ zlib. القراءة عبر mmap: نمشي على الـ headers
+#    ونفك فقط الـ frames داخل المدى الزمني، والأعمدة تُقرأ كـ numpy views بدون قواميس.
+HISTORY_DIR = f"{DATA_PATH}/history"
+HISTORY_RETENTION_DAYS = int(os.environ.get("HISTORY_RETENTION_DAYS", "30"))
+HISTORY_MAX_BYTES = int(os.environ.get("HISTORY_MAX_BYTES", str(128 * 1024 * 1024)))  # من قرص 0.5GB
+HISTORY_MAX_FRAMES = 500
+HISTORY_ZLIB_LEVEL = 6
+
+_HIST_MAGIC = b"GHX1"
+_HIST_HEADER = struct.Struct("<4sdII")   # magic, timestamp, rows, compressed bytes
+_HIST_COLUMNS = (("expiry", np.int32), ("strike", np.float64), ("net_gamma", np.float32),
+                 ("call_oi", np.float32), ("put_oi", np.float32), ("call_iv", np.float32), ("put_iv", np.float32))
+_HIST_ROW_BYTES = sum(np.dtype(dtype).itemsize for _, dtype in _HIST_COLUMNS)
+
+def history_columns(metrics):
+    """🔹 أعمدة السترايك لكل expiry مستهدف (expiry كرقم يوم ordinal) → dict أو None."""
+    parts = [(ex, m) for ex, m in sorted(metrics.items()) if len(m)]
+    if not parts:
         return None
+    cols = {
+        "expiry":    np.concatenate([np.full(len(m), dt.date.fromisoformat(ex).toordinal()) for ex, m in parts]),
+        "strike":    np.concatenate([m.strikes for _, m in parts]),
+        "net_gamma": np.concatenate([m.net_gex for _, m in parts]),
+        "call_oi":   np.concatenate([m.call_oi for _, m in parts]),
+        "put_oi":    np.concatenate([m.put_oi for _, m in parts]),
+        "call_iv":   np.concatenate([m.call_iv for _, m in parts]),
+        "put_iv":    np.concatenate([m.put_iv for _, m in parts]),
+    }
+    return {name: np.ascontiguousarray(cols[name], dtype=dtype) for name, dtype in _HIST_COLUMNS}
+
+class HistoryStore:
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._ends = {}   # path → نهاية آخر frame سليم كتبناه (لا حاجة لفحص الذيل مجددًا)
+
+    def _day_path(self, symbol, day):
+        return os.path.join(self.root, symbol, f"{day.isoformat()}.bin")
+
+    @staticmethod
+    def _good_end(f, size):
+        """نهاية آخر frame مكتمل (headers فقط، بدون فك ضغط)؛ header تالف في الوسط → نكمل من الـ magic التالي."""
+        good = off = 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            while 0 <= off and off + _HIST_HEADER.size <= size:
+                magic, _, _, length = _HIST_HEADER.unpack_from(mm, off)
+                if magic == _HIST_MAGIC and off + _HIST_HEADER.size + length <= size:
+                    off = good = off + _HIST_HEADER.size + length
+                else:
+                    off = mm.find(_HIST_MAGIC, off + 1)
+        return good
+
+    def _repair_tail(self, path):
+        """ذيل مبتور (crash أثناء الكتابة) → نقص الملف لآخر frame سليم قبل الإلحاق بعده."""
+        size = os.path.getsize(path)
+        if self._ends.get(path) == size or size == 0:
+            return
+        with open(path, "r+b") as f:
+            good = self._good_end(f, size)
+            if good < size:
+                print(f"[History] truncated {size - good} trailing bytes in {path}")
+                f.truncate(good)
+        self._ends[path] = good
+
+    def append(self, symbol, ts, cols):
+        """يضيف frame واحدًا لملف اليوم؛ أول frame في يوم جديد يشغّل التنظيف."""
+        if not cols:
+            return
+        rows = len(cols["strike"])
+        payload = zlib.compress(b"".join(cols[name].tobytes() for name, _ in _HIST_COLUMNS), HISTORY_ZLIB_LEVEL)
+        path = self._day_path(symbol, dt.datetime.fromtimestamp(ts, dt.timezone.utc).date())
+        frame = _HIST_HEADER.pack(_HIST_MAGIC, ts, rows, len(payload)) + payload
+        with self._lock:
+            new_day = not os.path.exists(path)
+            if new_day:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            else:
+                self._repair_tail(path)
+            with open(path, "ab") as f:
+                f.write(frame)
+                self._ends[path] = f.tell()
+            if new_day:
+                self._prune()
+
+    def _prune(self):
+        """🧹 يحذف الأيام الأقدم من HISTORY_RETENTION_DAYS، ثم الأقدم فالأقدم حتى HISTORY_MAX_BYTES."""
+        cutoff = (dt.datetime.now(dt.timezone.utc).date() - dt.timedelta(days=HISTORY_RETENTION_DAYS)).isoformat()
+        files = []
+        for sym in os.listdir(self.root):
+            sym_dir = os.path.join(self.root, sym)
+            if not os.path.isdir(sym_dir):
+                continue
+            for name in os.listdir(sym_dir):
+                if name.endswith(".bin"):
+                    path = os.path.join(sym_dir, name)
+                    files.append((name[:-4], os.path.getsize(path), path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for day, size, path in files:
+            if day >= cutoff and total <= HISTORY_MAX_BYTES:
+                break
+            os.remove(path)
+            total -= size
+            print(f"[History] pruned {path}")
 
-    # Weekly targets
-    exp_curr = nearest_weekly(expiries, next_week=False)
-    exp_next = nearest_weekly(expiries, next_week=True)
-    exp_m    = nearest_monthly(expiries)
+    def _frames(self, path, t0, t1):
+        """
+        يقرأ frames الملف داخل [t0, t1] عبر mmap → (ts, أعمدة numpy).
+        frame تالف أو مبتور يُتخطى: نعيد المزامنة على الـ magic التالي بدل إيقاف قراءة اليوم كله.
+        """
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < _HIST_HEADER.size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                off, end = 0, len(mm)
+                while off + _HIST_HEADER.size <= end:
+                    magic, ts, rows, size = _HIST_HEADER.unpack_from(mm, off)
+                    body = off + _HIST_HEADER.size
+                    if magic != _HIST_MAGIC or body + size > end:
+                        off = mm.find(_HIST_MAGIC, off + 1)
+                        if off < 0:
+                            break
+                        continue
+                    if ts < t0 or ts > t1:
+                        off = body + size
+                        continue
+                    try:
+                        raw = zlib.decompress(mm[body:body + size])
+                    except zlib.error:
+                        raw = b""
+                    if len(raw) != rows * _HIST_ROW_BYTES:
+                        print(f"[WARN] corrupt history frame at {path}:{off} → resync")
+                        off = mm.find(_HIST_MAGIC, off + 1)
+                        if off < 0:
+                            break
+                        continue
+                    off = body + size
+                    cols, pos = {}, 0
+                    for name, dtype in _HIST_COLUMNS:
+                        cols[name] = np.frombuffer(raw, dtype=dtype, count=rows, offset=pos)
+                        pos += rows * np.dtype(dtype).itemsize
+                    yield ts, cols
+
+    def query(self, symbol, t0, t1, limit=HISTORY_MAX_FRAMES):
+        """🔹 frames الرمز بين t0 و t1 (epoch) بالترتيب الزمني؛ الأيام خارج المدى لا تُفتح."""
+        d0 = dt.datetime.fromtimestamp(t0, dt.timezone.utc).date().isoformat()
+        d1 = dt.datetime.fromtimestamp(t1, dt.timezone.utc).date().isoformat()
+        sym_dir = os.path.join(self.root, symbol)
+        if not os.path.isdir(sym_dir):
+            return
+        days = sorted(n[:-4] for n in os.listdir(sym_dir) if n.endswith(".bin"))
+        n = 0
+        for day in days:
+            if day < d0 or day > d1:
+                continue
+            for frame in self._frames(os.path.join(sym_dir, f"{day}.bin"), t0, t1):
+                if n >= limit:
+                    return
+                yield frame
+                n += 1
+
+HISTORY = HistoryStore(HISTORY_DIR)
 
-    # Weekly / Monthly picks
-    wc_price, wc_picks = analyze_gamma_iv_v51(rows, exp_curr, split_by_price=True) if exp_curr else (None, [])
-    wn_price, wn_picks = analyze_gamma_iv_v51(rows, exp_next, split_by_price=True) if exp_next else (None, [])
-    m_price,  m_picks  = analyze_gamma_iv_v51(rows, exp_m,    split_by_price=True) if exp_m    else (None, [])
+# -------------------- Update + Cache -----------------------
+def update_symbol_data(symbol):
+    plan = plan_fetch(symbol)
+    chain = fetch_all(symbol, plan)
+    if not len(chain):
+        return None
 
-    # EM
-    em_curr_price, em_curr_iv, em_curr_value = compute_weekly_em(rows, exp_curr) if exp_curr else (None, None, None)
-    em_next_price, em_next_iv, em_next_value = compute_weekly_em(rows, exp_next) if exp_next else (None, None, None)
+    # 🔹 مرحلة الحساب (inline أو Process Pool)
+    res = run_compute(symbol, chain, plan["targets"] if plan else None)
+    del chain
+    if res is None:
+        return None
+    exp_curr, exp_next = res["weekly_current"]["expiry"], res["weekly_next"]["expiry"]
 
     # ΔOI + ΔIV signals per weekly expiry
     signals = {}
     for tag, ex in (("current", exp_curr), ("next", exp_next)):
         if ex:
             # aggregate today
-            agg_today = _aggregate_oi_iv(rows, ex, ref_price=wc_price if tag=="current" else wn_price)
+            agg_today = res["agg"][tag]
             # make baseline if not exist for today (أول مرة تُستدعى اليوم)
             base = _get_baseline(symbol, ex)
             if base is None and agg_today:
@@ -605,124 +1708,462 @@ def update_symbol_data(symbol):
 
     data = {
         "symbol": symbol,
-        "weekly_current": {"expiry": exp_curr, "price": wc_price, "picks": wc_picks},
-        "weekly_next":    {"expiry": exp_next, "price": wn_price, "picks": wn_picks},
-        "monthly":        {"expiry": exp_m,    "price": m_price,  "picks": m_picks},
-        "em": {
-            "current": {"price": em_curr_price, "iv_annual": em_curr_iv, "weekly_em": em_curr_value},
-            "next":    {"price": em_next_price, "iv_annual": em_next_iv, "weekly_em": em_next_value},
-        },
+        "weekly_current": res["weekly_current"],
+        "weekly_next":    res["weekly_next"],
+        "monthly":        res["monthly"],
+        "em":             res["em"],
         "signals": signals,
+        "term": res["term"],
         "timestamp": time.time()
     }
-    # 🔄 تحليل تدفق السيولة (Flow)
-    prev = {}
-    try:
-        with open(f"{DATA_PATH}/all.json", "r", encoding="utf-8") as f:
-            prev_file = json.load(f)
-            prev = (prev_file.get("data", {}).get(symbol, {}) or {})
-    except:
-        pass
+    # 🔄 تحليل تدفق السيولة (Flow) — مقابل الـ ring buffer في الذاكرة لكل نافذة
+    data["flow"] = track_flow(symbol, res["flow_map"], now=data["timestamp"])
 
-    flow_result = track_flow(symbol, rows, prev)
-    data["flow"] = flow_result
+    # 🗂️ سجل مقاييس السترايك (لتتبع حركة جدران الـ gamma خلال الأسبوع)
+    try:
+        HISTORY.append(symbol, data["timestamp"], res["history"])
+    except OSError as e:
+        print(f"[WARN] history append failed for {symbol}: {e}")
 
     earn_date = get_next_earnings(symbol)
     data["earnings_date"] = earn_date
     return data
 
-def get_symbol_data(symbol):
-    now = time.time()
-    if symbol in CACHE and (now - CACHE[symbol]["timestamp"] < CACHE_EXPIRY):
-        return CACHE[symbol]
-    data = update_symbol_data(symbol)
-    if data: CACHE[symbol] = data
-    return data
+# -------------------- Snapshots ----------------------------
+class Snapshot:
+    """
+    🔹 نسخة ثابتة (immutable) من بيانات كل الرموز برقم إصدار.
+    لا تُعدّل بعد النشر: التحديث يبني نسخة جديدة وينشرها بتبديل مرجع واحد،
+    والطلب يثبّت نسخة واحدة (pin) فلا يخلط بيانات دورتين.
+    """
+    __slots__ = ("version", "timestamp", "updated", "data", "symbol_versions", "restored")
+
+    def __init__(self, version, data, symbol_versions, timestamp=None, restored=()):
+        self.version = version
+        self.timestamp = timestamp or time.time()
+        self.updated = dt.datetime.fromtimestamp(self.timestamp, dt.timezone(dt.timedelta(hours=3))) \
+                         .strftime("%Y-%m-%d %H:%M:%S")
+        self.data = MappingProxyType(dict(data))
+        self.symbol_versions = MappingProxyType(dict(symbol_versions))  # symbol → آخر إصدار تغيّر فيه
+        self.restored = frozenset(restored)  # رموز ما زالت من نسخة القرص (stale) ولم تُحدَّث بعد
+
+    def get(self, symbol):
+        return self.data.get(symbol)
+
+# -------------------- Snapshot store (SQLite WAL) -----------
+# 🔹 صف لكل (symbol, version) يُكتب داخل transaction عند كل publish — لا إعادة كتابة لملف كامل،
+#    وآخر/سابق نسخة لكل رمز بـ lookup على المفتاح الأساسي.
+SNAPSHOT_DB = f"{DATA_PATH}/snapshots.db"
+SNAPSHOT_KEEP = max(2, int(os.environ.get("SNAPSHOT_KEEP", "48")))  # عدد النسخ المحفوظة لكل رمز
+
+class SnapshotStore:
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS symbol_snapshots (
+        symbol  TEXT    NOT NULL,
+        version INTEGER NOT NULL,
+        ts      REAL    NOT NULL,
+        data    TEXT    NOT NULL,
+        PRIMARY KEY (symbol, version)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS meta (
+        key   TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """
 
-# ---------------------- /all/pine --------------------------
-@app.route("/all/pine")
-def all_pine():
-    if not POLY_KEY:
-        return _err("Missing POLYGON_API_KEY", 401)
+    def __init__(self, path, keep=SNAPSHOT_KEEP):
+        self.path = path
+        self.keep = keep
+        self._local = threading.local()   # اتصال لكل thread (WAL: قرّاء متزامنون + كاتب واحد)
+        self._init_lock = threading.Lock()
+        self._ready = False
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            _ensure_data_dir()
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self._init_lock:
+                if not self._ready:
+                    conn.executescript(self.SCHEMA)
+                    self._ready = True
+            self._local.conn = conn
+        return conn
+
+    def write(self, version, updates, updated):
+        """يكتب صفوف الرموز المحدّثة + الإصدار في transaction واحدة، ويحذف النسخ الأقدم من keep."""
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO symbol_snapshots (symbol, version, ts, data) VALUES (?, ?, ?, ?)",
+                [(sym, version, d.get("timestamp") or time.time(),
+                  json.dumps(d, ensure_ascii=False, separators=(",", ":"))) for sym, d in updates.items()])
+            conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [("version", str(version)), ("updated", updated)])
+            for sym in updates:
+                conn.execute(
+                    "DELETE FROM symbol_snapshots WHERE symbol = ? AND version < "
+                    "(SELECT version FROM symbol_snapshots WHERE symbol = ? ORDER BY version DESC LIMIT 1 OFFSET ?)",
+                    (sym, sym, self.keep - 1))
+
+    def meta(self, key, default=None):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def latest(self, symbol):
+        row = self._conn().execute(
+            "SELECT data FROM symbol_snapshots WHERE symbol = ? ORDER BY version DESC LIMIT 1",
+            (symbol,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def previous(self, symbol, before_version):
+        """آخر نسخة للرمز قبل before_version → (version, data) أو None."""
+        row = self._conn().execute(
+            "SELECT version, data FROM symbol_snapshots WHERE symbol = ? AND version < ? "
+            "ORDER BY version DESC LIMIT 1", (symbol, before_version)).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def latest_all(self):
+        """{symbol: (version, data)} — آخر صف لكل رمز."""
+        rows = self._conn().execute(
+            "SELECT s.symbol, s.version, s.data FROM symbol_snapshots s "
+            "JOIN (SELECT symbol, MAX(version) AS v FROM symbol_snapshots GROUP BY symbol) m "
+            "ON s.symbol = m.symbol AND s.version = m.v").fetchall()
+        return {sym: (v, json.loads(d)) for sym, v, d in rows}
+
+    def import_legacy(self, path):
+        """استيراد لمرة واحدة من all.json القديم لو القاعدة فارغة."""
+        if self.meta("version") is not None or not os.path.exists(path):
+            return 0
+        saved = _read_persisted(path)
+        data = {sym: d for sym, d in saved.get("data", {}).items()
+                if isinstance(d, dict) and "timestamp" in d}
+        version = int(saved.get("version") or 0) or (1 if data else 0)
+        if data:
+            self.write(version, data, saved.get("updated") or "")
+            print(f"📥 Imported {len(data)} symbols from legacy {os.path.basename(path)} (v{version})")
+        return len(data)
+
+STORE = SnapshotStore(SNAPSHOT_DB)
+
+_SNAPSHOT = None                  # يُحمَّل من SnapshotStore عند أول وصول (warm restart)
+_PUBLISH_LOCK = threading.Lock()  # يسلسل الكتّاب فقط؛ القرّاء بلا قفل
+_RESTORE_LOCK = threading.Lock()
+
+def _read_persisted(path):
+    """يقرأ all.json القديم بأمان (إصلاح list بدل dict كما في النسخ القديمة)."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+    except Exception as e:
+        print(f"[ERROR] Failed to load all.json: {e}")
+        return {}
+    if not isinstance(saved, dict):
+        print("[WARN] all.json was not a dict → ignoring")
+        return {}
+    if not isinstance(saved.get("data"), dict):
+        print("[WARN] all.json['data'] was not a dict → ignoring")
+        saved["data"] = {}
+    return saved
+
+def _restore_snapshot():
+    """
+    🔹 Warm restart: آخر نسخة محفوظة تُخدم فورًا بعد الإقلاع، مُعلَّمة كـ restored (stale)،
+    والتحديث يجري في الخلفية. رقم الإصدار يُستكمل من القاعدة حتى لا يتكرر بعد إعادة التشغيل.
+    """
+    try:
+        STORE.import_legacy(ALL_FILE)
+        rows = STORE.latest_all()
+        version = int(STORE.meta("version") or 0)
+        updated = STORE.meta("updated")
+    except sqlite3.Error as e:
+        print(f"[ERROR] Failed to load snapshot store: {e}")
+        rows, version, updated = {}, 0, None
+    data = {sym: d for sym, (_, d) in rows.items()}
+    # وقت النسخة = أحدث بيانات محفوظة (لا وقت الإقلاع) حتى لا تبدو البيانات القديمة جديدة
+    saved_at = max((d.get("timestamp") or 0 for d in data.values()), default=0) or None
+    snap = Snapshot(version, data, {sym: v for sym, (v, _) in rows.items()}, timestamp=saved_at, restored=data)
+    if data:
+        print(f"♻️ Restored snapshot v{version} ({len(data)} symbols, saved {updated})")
+    return snap
+
+def current_snapshot():
+    """قراءة مرجع واحد (ذرّية) — النسخة المنشورة حاليًا."""
+    global _SNAPSHOT
+    snap = _SNAPSHOT
+    if snap is None:
+        with _RESTORE_LOCK:
+            if _SNAPSHOT is None:
+                _SNAPSHOT = _restore_snapshot()
+            snap = _SNAPSHOT
+    return snap
+
+# -------------------- Change feed (SSE / long-poll) ----------
+# 🔹 كل publish يضيف حدثًا مضغوطًا (فروقات picks / signal / EM لكل رمز) برقم الإصدار،
+#    والمشتركون ينتظرون على Condition واحد مشترك بدل polling على /all/json.
+STREAM_BACKLOG = int(os.environ.get("STREAM_BACKLOG", "256"))   # عدد الأحداث المحفوظة للاستئناف
+_DIFF_TAGS = ("weekly_current", "weekly_next", "monthly")
+
+def _same(a, b):
+    # مقارنة عبر JSON: tuple/list متساويان، و NaN == NaN
+    return json.dumps(a, sort_keys=True) == json.dumps(b, sort_keys=True)
+
+def _symbol_diff(old, new):
+    """فرق مضغوط بين نسختين لرمز واحد: picks لكل expiry، نص الإشارة، و EM."""
+    old = old or {}
+    diff = {}
+    for tag in _DIFF_TAGS:
+        o, n = old.get(tag) or {}, new.get(tag) or {}
+        o_picks, n_picks = _to_obj(o.get("picks", [])), _to_obj(n.get("picks", []))
+        if o.get("expiry") != n.get("expiry") or not _same(o_picks, n_picks):
+            diff[tag] = {"expiry": n.get("expiry"), "price": n.get("price"), "picks": n_picks}
+    o_sig, n_sig = old.get("signals") or {}, new.get("signals") or {}
+    sig = {t: ((n_sig.get(t) or {}).get("signal") or {}).get("signal") for t in ("current", "next")}
+    if sig != {t: ((o_sig.get(t) or {}).get("signal") or {}).get("signal") for t in ("current", "next")}:
+        diff["signals"] = sig
+    if not _same(old.get("em"), new.get("em")):
+        diff["em"] = new.get("em")
+    return diff
+
+class ChangeFeed:
+    """
+    سجل أحداث محدود (deque) مفهرس برقم إصدار الـ Snapshot + Condition واحد لكل المشتركين.
+    العميل يستأنف من آخر إصدار رآه؛ لو سقط خارج السجل يصله resync ليعيد جلب /all/json.
+    """
+    def __init__(self, maxlen):
+        self._events = deque(maxlen=maxlen)   # (version, updated, {symbol: diff})
+        self._cond = threading.Condition()
+        self._floor = None                    # السجل كامل لكل إصدار > _floor
+        self._last = None
+
+    def push(self, old_version, version, updated, diffs):
+        with self._cond:
+            if self._floor is None:
+                self._floor = old_version
+            if len(self._events) == self._events.maxlen:
+                self._floor = self._events[0][0]
+            self._events.append((version, updated, diffs))
+            self._last = version
+            self._cond.notify_all()
+
+    def latest(self):
+        return self._last if self._last is not None else current_snapshot().version
+
+    def since(self, last_id):
+        """→ (events, resync) — الأحداث بعد last_id، و resync=True لو فاتت العميل أحداث محذوفة."""
+        latest = self.latest()
+        if last_id is None or last_id >= latest:
+            return [], False
+        floor = self._floor if self._floor is not None else latest
+        if last_id < floor:
+            return [], True
+        return [e for e in list(self._events) if e[0] > last_id], False
+
+    def wait(self, last_id, timeout):
+        with self._cond:
+            self._cond.wait_for(lambda: last_id is None or self.latest() > last_id, timeout)
+        return self.since(last_id)
+
+_FEED = ChangeFeed(STREAM_BACKLOG)
+
+def publish(updates):
+    """
+    ينشر نسخة جديدة = النسخة الحالية + updates {symbol: data} بتبديل مرجع واحد.
+    دورة التحديث الكاملة تنشر مرة واحدة؛ تحديث رمز منفرد (SWR) ينشر إصدارًا خاصًا به.
+    بيانات منشورة مسبقًا (نفس الكائن، مثل تحديث طلب انضمت إليه الدورة) لا تُنشر مرتين.
+    """
+    global _SNAPSHOT
+    if not updates:
+        return current_snapshot()
+    with _PUBLISH_LOCK:
+        old = current_snapshot()
+        updates = {sym: d for sym, d in updates.items() if old.data.get(sym) is not d}
+        if not updates:
+            return old
+        version = old.version + 1
+        data = dict(old.data)
+        data.update(updates)
+        versions = dict(old.symbol_versions)
+        versions.update((sym, version) for sym in updates)
+        snap = _SNAPSHOT = Snapshot(version, data, versions, restored=old.restored.difference(updates))
+        diffs = {}
+        for sym, d in updates.items():
+            diff = _symbol_diff(old.get(sym), d)
+            if diff:
+                diffs[sym] = diff
+        _FEED.push(old.version, version, snap.updated, diffs)  # حتى بلا فروقات: يحفظ تسلسل الإصدارات
+        try:
+            STORE.write(version, updates, snap.updated)
+        except sqlite3.Error as e:
+            print(f"[ERROR] Snapshot store write failed (v{version}): {e}")
+    print(f"📦 Published snapshot v{version} ({len(updates)} symbols, {len(diffs)} changed)")
+    _log_published_opportunities(snap, updates)
+    return snap
+
+# 🔹 Stale-while-revalidate: بعد CACHE_EXPIRY نخدم النسخة القديمة ونحدّث في الخلفية،
+#    ولا ننتظر التحديث إلا لو لا توجد بيانات أو تجاوز عمرها MAX_STALENESS
+MAX_STALENESS = int(os.environ.get("MAX_STALENESS", str(6 * 3600)))
+SWR_WORKERS = max(1, int(os.environ.get("SWR_WORKERS", "2")))
+_SWR_POOL = ThreadPoolExecutor(max_workers=SWR_WORKERS, thread_name_prefix="swr")
+REFRESH_FAILURE_COOLDOWN = int(os.environ.get("REFRESH_FAILURE_COOLDOWN", "300"))  # ثواني بلا تحديث خلفي بعد الفشل
+_INFLIGHT = {}   # symbol → Future للتحديث الجاري (single-flight)؛ fut.publish = هل يُنشر عند الانتهاء
+_FAILED_AT = {}  # symbol → وقت آخر تحديث فاشل (يُمسح عند النجاح)
+_INFLIGHT_LOCK = threading.Lock()
+
+def _run_refresh(symbol, fut):
+    try:
+        data = update_symbol_data(symbol)
+    except Exception as e:
+        print(f"❌ Refresh {symbol} failed: {e}")
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(symbol, None)
+            _FAILED_AT[symbol] = time.time()
+        fut.set_exception(e)
+        return
+    # نقرأ العلم ونخرج من _INFLIGHT معًا: من ينضم بعدها يبدأ تحديثًا جديدًا
+    with _INFLIGHT_LOCK:
+        _INFLIGHT.pop(symbol, None)
+        publish_now = fut.publish
+        if data:
+            _FAILED_AT.pop(symbol, None)
+        else:
+            _FAILED_AT[symbol] = time.time()
+    try:
+        if data and publish_now:
+            publish({symbol: data})  # قبل set_result: المنتظرون يجدون الرمز في النسخة المنشورة
+    finally:
+        fut.set_result(data)
 
-    blocks = []
+def _single_flight(symbol, background=False, publish_now=True):
+    """
+    تحديث واحد فقط لكل رمز في أي لحظة: المتصلون المتزامنون يشتركون في نفس الـ Future.
+    background=True → يُنفّذ في _SWR_POOL، وإلا في thread المتصل الأول (الذي يملك التحديث).
+    publish_now=False → النتيجة لا تُنشر هنا (دورة auto_refresh تنشر الكل مرة واحدة)،
+    إلا لو انضم للتحديث نفسه متصل يحتاج النشر (طلب ينتظر الرمز) — يُنشر حينها مرة واحدة.
+    تحديث خلفي جديد بعد فشل حديث (< REFRESH_FAILURE_COOLDOWN) لا يبدأ → None (نخدم المخزن).
+    """
+    with _INFLIGHT_LOCK:
+        fut = _INFLIGHT.get(symbol)
+        owner = fut is None
+        if owner and background and time.time() - _FAILED_AT.get(symbol, 0) < REFRESH_FAILURE_COOLDOWN:
+            return None
+        if owner:
+            fut = _INFLIGHT[symbol] = Future()
+            fut.publish = publish_now
+        elif publish_now:
+            fut.publish = True
+    if owner:
+        if background:
+            _SWR_POOL.submit(_run_refresh, symbol, fut)
+        else:
+            _run_refresh(symbol, fut)
+    return fut
 
-    # ===============================
-    # 🔹 تحديد بداية الأسبوع للمقارنة
-    # ===============================
-    today = dt.date.today()
-    monday = today - dt.timedelta(days=today.weekday())  # يوم الاثنين الحالي
-    monday_key = monday.isoformat()
-    today_key = today.isoformat()
+def refresh_symbol(symbol):
+    """يحدّث الرمز (أو ينضم لتحديث جارٍ) وينتظر النتيجة."""
+    return _single_flight(symbol).result()
 
-    # ✅ تحميل بيانات baseline من الملف (لضمان توفرها)
-    load_baseline()
+def _refresh_for_cycle(symbol):
+    return _single_flight(symbol, publish_now=False).result()
 
-    for sym in SYMBOLS:
-        data = get_symbol_data(sym)
-        if not data:
+def pin_snapshot(symbols=None, wait=True):
+    """
+    🔹 يرجع Snapshot واحدًا يستخدمه الطلب كاملًا.
+    الرموز القديمة (stale) أو المسترجعة من القرص تُحدَّث في الخلفية؛ الرموز المفقودة أو الأقدم
+    من MAX_STALENESS تُحدَّث بالتوازي وننتظرها، ثم نثبّت النسخة المنشورة بعدها.
+    wait=False → لا ينتظر Polygon أبدًا: حتى المفقود يُحدَّث في الخلفية ونخدم الموجود.
+    """
+    snap = current_snapshot()
+    now = time.time()
+    blocking = []
+    for sym in symbols or SYMBOLS:
+        entry = snap.get(sym)
+        age = now - entry["timestamp"] if entry else None
+        if entry and age < CACHE_EXPIRY and sym not in snap.restored:
             continue
+        if not wait or entry and (age < MAX_STALENESS or sym in snap.restored):
+            _single_flight(sym, background=True)
+        else:
+            blocking.append(sym)
+    if blocking:
+        refresh_symbols(blocking, fn=refresh_symbol)  # الفشل (PolygonError) → نخدم النسخة المخزنة
+        snap = current_snapshot()
+    return snap
+
+def _versioned(resp, snap):
+    """يضيف رقم إصدار النسخة لكل استجابة."""
+    resp.headers["X-Snapshot-Version"] = str(snap.version)
+    if snap.restored:
+        resp.headers["X-Snapshot-Stale"] = str(len(snap.restored))  # رموز ما زالت من نسخة القرص
+    return resp
 
-        # ===============================
-        # 🧠 تحليل السيولة الأسبوعي
-        # ===============================
-        flow_signal = "⚪ لا بيانات أسبوعية"
-
-        base_week = DAILY_BASE.get(sym, {})
-        for expiry, daily_points in base_week.items():
-            base_mon = daily_points.get(monday_key)
-            base_today = daily_points.get(today_key)
-            if base_mon and base_today:
-                d_calls = base_today["calls"] - base_mon["calls"]
-                d_puts  = base_today["puts"]  - base_mon["puts"]
-
-                if d_calls > 0 and d_puts < 0:
-                    flow_signal = "📈 تدفق صعودي من بداية الأسبوع"
-                elif d_calls < 0 and d_puts > 0:
-                    flow_signal = "📉 تدفق هبوطي من بداية الأسبوع"
-                else:
-                    flow_signal = "⚪ تدفق متذبذب"
-                break  # نوقف عند أول expiry نلقاه
+# ---------------------- /all/pine --------------------------
+# 🔹 كاش Pine: كل رمز يُرسم مرة واحدة لكل إصدار له في الـ Snapshot (+ اليوم لأن التدفق
+#    الأسبوعي يعتمد على تاريخ اليوم)، والسكربت المجمّع يُحفظ bytes مع ETag لكل إصدار.
+_PINE_BLOCKS = {}   # symbol → ((symbol_version, today_key), block)
+_PINE_DOCS = {}     # (format, symbols tuple) → ((snapshot_version, today_key), bytes, etag, budget)
+
+def _pine_block(sym, data, monday_key, today_key):
+    # ===============================
+    # 🧠 تحليل السيولة الأسبوعي
+    # ===============================
+    flow_signal = "⚪ لا بيانات أسبوعية"
+
+    points = BASELINES.weekly_points(sym, monday_key, today_key)  # أول expiry فيه النقطتان
+    if points:
+        base_mon, base_today = points
+        d_calls = base_today["calls"] - base_mon["calls"]
+        d_puts  = base_today["puts"]  - base_mon["puts"]
+
+        if d_calls > 0 and d_puts < 0:
+            flow_signal = "📈 تدفق صعودي من بداية الأسبوع"
+        elif d_calls < 0 and d_puts > 0:
+            flow_signal = "📉 تدفق هبوطي من بداية الأسبوع"
+        else:
+            flow_signal = "⚪ تدفق متذبذب"
 
-        # ✅ بإمكانك طباعة النتيجة للمراجعة في الـ Logs
-        print(f"[FlowWeek] {sym}: {flow_signal}")
+    # ✅ بإمكانك طباعة النتيجة للمراجعة في الـ Logs
+    print(f"[FlowWeek] {sym}: {flow_signal}")
 
-        # -------------------------------------------------------
-        # 👇 بعدين يكمّل الكود الأصلي بالضبط كما هو بدون حذف
-        # -------------------------------------------------------
+    # -------------------------------------------------------
+    # 👇 بعدين يكمّل الكود الأصلي بالضبط كما هو بدون حذف
+    # -------------------------------------------------------
 
-        # Weekly CURRENT arrays
-        wc_s, wc_p, wc_iv, wc_sgn = normalize_for_pine_v51(data["weekly_current"]["picks"])
-        # Weekly NEXT arrays
-        wn_s, wn_p, wn_iv, wn_sgn = normalize_for_pine_v51(data["weekly_next"]["picks"])
-        # Monthly arrays
-        m_s,  m_p,  m_iv,  m_sgn  = normalize_for_pine_v51(data["monthly"]["picks"])
+    # Weekly CURRENT arrays
+    wc_s, wc_p, wc_iv, wc_sgn = normalize_for_pine_v51(data["weekly_current"]["picks"])
+    # Weekly NEXT arrays
+    wn_s, wn_p, wn_iv, wn_sgn = normalize_for_pine_v51(data["weekly_next"]["picks"])
+    # Monthly arrays
+    m_s,  m_p,  m_iv,  m_sgn  = normalize_for_pine_v51(data["monthly"]["picks"])
 
-        # EM (current/next)
-        em_c = data.get("em", {}).get("current", {}) or {}
-        em_n = data.get("em", {}).get("next", {}) or {}
+    # EM (current/next)
+    em_c = data.get("em", {}).get("current", {}) or {}
+    em_n = data.get("em", {}).get("next", {}) or {}
 
-        em_c_val = em_c.get("weekly_em"); em_c_iv = em_c.get("iv_annual"); em_c_pr = em_c.get("price")
-        em_n_val = em_n.get("weekly_em"); em_n_iv = em_n.get("iv_annual"); em_n_pr = em_n.get("price")
+    em_c_val = em_c.get("weekly_em"); em_c_iv = em_c.get("iv_annual"); em_c_pr = em_c.get("price")
+    em_n_val = em_n.get("weekly_em"); em_n_iv = em_n.get("iv_annual"); em_n_pr = em_n.get("price")
 
-        emc_txt = "na" if em_c_val is None else f"{float(em_c_val):.6f}"
-        emc_ivt = "na" if em_c_iv  is None else f"{float(em_c_iv):.6f}"
-        emc_prt = "na" if em_c_pr  is None else f"{float(em_c_pr):.6f}"
+    emc_txt = "na" if em_c_val is None else f"{float(em_c_val):.6f}"
+    emc_ivt = "na" if em_c_iv  is None else f"{float(em_c_iv):.6f}"
+    emc_prt = "na" if em_c_pr  is None else f"{float(em_c_pr):.6f}"
 
-        emn_txt = "na" if em_n_val is None else f"{float(em_n_val):.6f}"
-        emn_ivt = "na" if em_n_iv  is None else f"{float(em_n_iv):.6f}"
-        emn_prt = "na" if em_n_pr  is None else f"{float(em_n_pr):.6f}"
+    emn_txt = "na" if em_n_val is None else f"{float(em_n_val):.6f}"
+    emn_ivt = "na" if em_n_iv  is None else f"{float(em_n_iv):.6f}"
+    emn_prt = "na" if em_n_pr  is None else f"{float(em_n_pr):.6f}"
 
-        # Signals
-        sigs = data.get("signals", {}) or {}
-        sig_curr = sigs.get("current") or {}
-        sig_next = sigs.get("next") or {}
-        sig_text_curr = sig_curr.get("signal", {}).get("signal", "⚪ Neutral")
-        sig_text_next = sig_next.get("signal", {}).get("signal", "⚪ Neutral")
+    # Signals
+    sigs = data.get("signals", {}) or {}
+    sig_curr = sigs.get("current") or {}
+    sig_next = sigs.get("next") or {}
+    sig_text_curr = sig_curr.get("signal", {}).get("signal", "⚪ Neutral")
+    sig_text_next = sig_next.get("signal", {}).get("signal", "⚪ Neutral")
 
-        # ✳️ هنا تقدر تضيف لاحقًا سطر داخل الـ block لإظهار flow_signal داخل Pine
+    # ✳️ هنا تقدر تضيف لاحقًا سطر داخل الـ block لإظهار flow_signal داخل Pine
 
-        block = f"""
+    block = f"""
 //========= {sym} =========
 if syminfo.ticker == "{sym}"
     title = " PRO • " + mode + " | {sym}"
@@ -809,13 +2250,12 @@ if syminfo.ticker == "{sym}"
         table.cell(sigT, 1, 2, earn_date, text_color=color.new(color.yellow, 0), bgcolor=color.new(color.black, 0), text_size=size.small)
 
 """
-        blocks.append(block)
-
-    now = dt.datetime.now(dt.timezone(dt.timedelta(hours=3)))
-    last_update = now.strftime("%Y-%m-%d %H:%M:%S")
+    return block
 
-    pine = f"""//@version=5
-// Last Update (Riyadh): {last_update}
+def _pine_header(snap):
+    return f"""//@version=5
+// Last Update (Riyadh): {snap.updated}
+// Snapshot Version: {snap.version}
 indicator("GEX PRO (v6.9)", overlay=true, max_lines_count=500, max_labels_count=500, dynamic_requests=true)
 
 // إعدادات عامة
@@ -840,7 +2280,7 @@ clear_visuals(_optLines, _optLabels) =>
 // رسم الأشرطة الاتجاهية (حتى 7)
 draw_bars(_s, _p, _iv, _sgn) =>
     if barstate.islast and array.size(_s) > 0 and array.size(_p) > 0 and array.size(_iv) > 0 and array.size(_sgn) > 0
-        limit = math.min(array.size(_s), 7)
+        limit = math.min(array.size(_s), {LEVELS_K})
         for i = 0 to limit - 1
             y   = array.get(_s, i)
             pct = array.get(_p, i)
@@ -856,9 +2296,275 @@ draw_bars(_s, _p, _iv, _sgn) =>
             label.new(bar_index + bar_len + 2, y, str.tostring(pct*100, "#.##") + "% | IV " + str.tostring(iv*100, "#.##"), style=label.style_label_left, color=color.rgb(95, 93, 93), textcolor=color.white, size=size.small)
 
 // --- Per-symbol blocks ---
-{''.join(blocks)}
 """
-    return Response(pine, mimetype="text/plain")
+
+def _render_pine(snap, symbols):
+    """يجمع السكربت من blocks مخزنة؛ فقط الرموز التي تغيّر إصدارها تُرسم من جديد."""
+    today = dt.date.today()
+    today_key = today.isoformat()
+    doc_key = (snap.version, today_key)
+    doc = _PINE_DOCS.get(("blocks", symbols))
+    if doc and doc[0] == doc_key:
+        return doc
+
+    # ===============================
+    # 🔹 تحديد بداية الأسبوع للمقارنة
+    # ===============================
+    monday = today - dt.timedelta(days=today.weekday())  # يوم الاثنين الحالي
+    monday_key = monday.isoformat()
+
+    blocks, rendered = [], 0
+    for sym in symbols:
+        data = snap.get(sym)
+        if not data:
+            continue
+        key = (snap.symbol_versions.get(sym), today_key)
+        cached = _PINE_BLOCKS.get(sym)
+        if cached and cached[0] == key:
+            blocks.append(cached[1])
+            continue
+        block = _pine_block(sym, data, monday_key, today_key)
+        _PINE_BLOCKS[sym] = (key, block)
+        blocks.append(block)
+        rendered += 1
+
+    body = (_pine_header(snap) + ''.join(blocks) + "\n").encode("utf-8")
+    doc = _store_pine_doc(("blocks", symbols), doc_key, body)
+    print(f"[Pine] v{snap.version}: rendered {rendered}/{len(blocks)} blocks ({len(body)} bytes)")
+    return doc
+
+# -------------------- Pine (table generator) ----------------
+# 🔹 بديل مضغوط: البيانات سطر نصي واحد لكل رمز داخل switch على syminfo.ticker، مع دالة رسم
+#    واحدة مشتركة و request.security واحد — الحجم والتعقيد لا يتضاعفان مع عدد الرموز.
+#    صيغة السطر: wc | wn | m | em_curr | em_next | sig_curr | sig_next | earnings
+#    والمستويات: strike:pct:iv:sgn مفصولة بفواصل.
+_PINE_ROWS = {}     # symbol → (symbol_version, row)
+
+# حدود تقريبية لميزانية TradingView (قابلة للتعديل حسب الخطة/الإصدار)
+PINE_MAX_CHARS          = int(os.environ.get("PINE_MAX_CHARS", "100000"))
+PINE_MAX_LOCAL_SCOPES   = int(os.environ.get("PINE_MAX_LOCAL_SCOPES", "500"))
+PINE_MAX_SECURITY_CALLS = int(os.environ.get("PINE_MAX_SECURITY_CALLS", "40"))
+_PINE_SCOPE_LINE = re.compile(r"^\s*(if |else\b|for |while |switch\b)|=>\s*$")
+
+def _pine_num(x, nd=4):
+    if x is None:
+        return ""
+    return (f"{float(x):.{nd}f}").rstrip("0").rstrip(".")
+
+def _pine_text(t):
+    # النص داخل "..." ومفصول بـ | → نحذف ما يكسر الصيغة
+    return str(t).replace("|", "/").replace('"', "'").replace("\\", "/").replace("\n", " ")
+
+def _pine_levels(picks):
+    s, p, iv, sgn = normalize_for_pine_v51(picks)
+    return ",".join(f"{_pine_num(a, 2)}:{_pine_num(b)}:{_pine_num(c)}:{d}" for a, b, c, d in zip(s, p, iv, sgn))
+
+def _pine_row(data):
+    em = data.get("em", {}) or {}
+    sigs = data.get("signals", {}) or {}
+    def _sig(tag):
+        return ((sigs.get(tag) or {}).get("signal", {}) or {}).get("signal", "⚪ Neutral")
+    def _em(tag):
+        v = (em.get(tag) or {}).get("weekly_em")
+        return "" if v is None else f"{float(v):.6f}"
+    cells = [
+        _pine_levels(data["weekly_current"]["picks"]),
+        _pine_levels(data["weekly_next"]["picks"]),
+        _pine_levels(data["monthly"]["picks"]),
+        _em("current"), _em("next"),
+        _pine_text(_sig("current")), _pine_text(_sig("next")),
+        _pine_text(data.get("earnings_date") or "N/A"),
+    ]
+    return "|".join(cells)
+
+def _pine_table_header(snap, n):
+    return f"""//@version=5
+// Last Update (Riyadh): {snap.updated}
+// Snapshot Version: {snap.version}
+// Generator: table ({n} symbols, 1 request.security)
+indicator("GEX PRO (v6.9)", overlay=true, max_lines_count=500, max_labels_count=500)
+
+// إعدادات عامة
+mode     = "Weekly"
+weekMode = input.string("Current", "Expiry Week", options=["Current","Next"])
+
+// السعر المرجعي الأسبوعي (استدعاء واحد للسكربت كله)
+weeklyClose = request.security(syminfo.tickerid, "W", close)
+
+// مصفوفات للرسم العام
+var line[]  optLines  = array.new_line()
+var label[] optLabels = array.new_label()
+
+// تنظيف
+clear_visuals(_optLines, _optLabels) =>
+    if array.size(_optLines) > 0
+        for l in _optLines
+            line.delete(l)
+        array.clear(_optLines)
+    if array.size(_optLabels) > 0
+        for lb in _optLabels
+            label.delete(lb)
+        array.clear(_optLabels)
+
+cell_txt(string[] _cells, int _i) =>
+    array.size(_cells) > _i ? array.get(_cells, _i) : ""
+
+cell_num(string[] _cells, int _i) =>
+    txt = cell_txt(_cells, _i)
+    txt == "" ? na : str.tonumber(txt)
+
+// رسم الأشرطة الاتجاهية (حتى {LEVELS_K}) من نص strike:pct:iv:sgn
+draw_levels(string _blob, line[] _lines, label[] _labels) =>
+    if str.length(_blob) > 0
+        items = str.split(_blob, ",")
+        limit = math.min(array.size(items), {LEVELS_K})
+        for i = 0 to limit - 1
+            parts = str.split(array.get(items, i), ":")
+            y   = str.tonumber(array.get(parts, 0))
+            pct = str.tonumber(array.get(parts, 1))
+            iv  = str.tonumber(array.get(parts, 2))
+            sgn = str.tonumber(array.get(parts, 3))
+
+            bar_col = sgn > 0 ? color.new(color.lime, 20) : sgn < 0 ? color.new(color.rgb(220,50,50), 20) : color.new(color.gray, 20)
+            alpha   = 90 - int(pct * 70)
+            bar_col := color.new(bar_col, alpha)
+            bar_len = int(math.max(10, pct * 50))
+
+            array.push(_lines, line.new(bar_index + 3, y, bar_index + bar_len + 12, y, color=bar_col, width=6))
+            array.push(_labels, label.new(bar_index + bar_len + 2, y, str.tostring(pct*100, "#.##") + "% | IV " + str.tostring(iv*100, "#.##"), style=label.style_label_left, color=color.rgb(95, 93, 93), textcolor=color.white, size=size.small))
+
+// --- Data table (one row per symbol) ---
+row = switch syminfo.ticker
+"""
+
+_PINE_TABLE_BODY = """    => ""
+
+gold = color.rgb(255, 215, 0)
+var line emTop  = line.new(na, na, na, na, extend=extend.both, color=gold, width=2, style=line.style_dotted)
+var line emBot  = line.new(na, na, na, na, extend=extend.both, color=gold, width=2, style=line.style_dotted)
+var label emTopL = na
+var label emBotL = na
+var table sigT = table.new(position.bottom_right, 2, 3)
+
+if barstate.islast and str.length(row) > 0
+    cells = str.split(row, "|")
+
+    // نظّف الرسومات القديمة ثم ارسم الأسبوع/الشهر المختار
+    clear_visuals(optLines, optLabels)
+    blob = mode == "Monthly" ? cell_txt(cells, 2) : weekMode == "Current" ? cell_txt(cells, 0) : cell_txt(cells, 1)
+    draw_levels(blob, optLines, optLabels)
+
+    // === Expected Move lines (gold), تتبع اختيار الأسبوع ===
+    em_value = weekMode == "Current" ? cell_num(cells, 3) : cell_num(cells, 4)
+    if not na(em_value)
+        up = weeklyClose + em_value
+        dn = weeklyClose - em_value
+        line.set_xy1(emTop, bar_index - 5, up)
+        line.set_xy2(emTop, bar_index + 5, up)
+        line.set_xy1(emBot, bar_index - 5, dn)
+        line.set_xy2(emBot, bar_index + 5, dn)
+        label.delete(emTopL)
+        label.delete(emBotL)
+        emTopL := label.new(bar_index, up, "📈 أعلى مدى متوقع: " + str.tostring(up, "#.##"),style=label.style_label_down, color=color.new(gold, 0), textcolor=color.black, size=size.small)
+        emBotL := label.new(bar_index, dn, "📉 أدنى مدى متوقع: " + str.tostring(dn, "#.##"),style=label.style_label_up,   color=color.new(gold, 0), textcolor=color.black, size=size.small)
+
+    // === Credit Signal Table (ΔOI + ΔIV) ===
+    table.cell(sigT, 0, 0, "الاسبوع  الحالي", text_color=color.white, bgcolor=color.new(color.black, 0), text_size=size.small)
+    table.cell(sigT, 1, 0, cell_txt(cells, 5), text_color=color.white, bgcolor=color.new(color.black, 0), text_size=size.small)
+    table.cell(sigT, 0, 1, "الاسبوع  القادم", text_color=color.white, bgcolor=color.new(color.black, 0), text_size=size.small)
+    table.cell(sigT, 1, 1, cell_txt(cells, 6), text_color=color.white, bgcolor=color.new(color.black, 0), text_size=size.small)
+    table.cell(sigT, 0, 2, "Next Earnings:", text_color=color.new(color.yellow, 0), bgcolor=color.new(color.black, 0), text_size=size.small)
+    table.cell(sigT, 1, 2, cell_txt(cells, 7), text_color=color.new(color.yellow, 0), bgcolor=color.new(color.black, 0), text_size=size.small)
+"""
+
+def pine_budget(body):
+    """📏 تقرير الحجم وميزانية التنفيذ التقريبية لسكربت Pine مُولَّد."""
+    text = body.decode("utf-8")
+    lines = text.splitlines()
+    report = {
+        "bytes": len(body),
+        "chars": len(text),
+        "lines": len(lines),
+        "local_scopes": sum(1 for l in lines if _PINE_SCOPE_LINE.search(l)),
+        "security_calls": text.count("request.security("),
+    }
+    report["within_budget"] = (report["chars"] <= PINE_MAX_CHARS
+                               and report["local_scopes"] <= PINE_MAX_LOCAL_SCOPES
+                               and report["security_calls"] <= PINE_MAX_SECURITY_CALLS)
+    return report
+
+def _store_pine_doc(key, doc_key, body):
+    doc = (doc_key, body, hashlib.sha1(body).hexdigest()[:20], pine_budget(body))
+    if len(_PINE_DOCS) >= JSON_CACHE_MAX:
+        _PINE_DOCS.clear()
+    _PINE_DOCS[key] = doc
+    return doc
+
+def _render_pine_table(snap, symbols):
+    """نسخة الجدول: صف نصي لكل رمز (مخزن لكل إصدار رمز) + جسم رسم مشترك واحد."""
+    doc_key = (snap.version, None)
+    doc = _PINE_DOCS.get(("table", symbols))
+    if doc and doc[0] == doc_key:
+        return doc
+    rows, rendered = [], 0
+    for sym in symbols:
+        data = snap.get(sym)
+        if not data:
+            continue
+        version = snap.symbol_versions.get(sym)
+        cached = _PINE_ROWS.get(sym)
+        if not cached or cached[0] != version:
+            cached = _PINE_ROWS[sym] = (version, _pine_row(data))
+            rendered += 1
+        rows.append(f'    "{sym}" => "{cached[1]}"\n')
+    body = (_pine_table_header(snap, len(rows)) + "".join(rows) + _PINE_TABLE_BODY).encode("utf-8")
+    doc = _store_pine_doc(("table", symbols), doc_key, body)
+    print(f"[Pine] v{snap.version}: table rendered {rendered}/{len(rows)} rows ({len(body)} bytes)")
+    return doc
+
+_PINE_FORMATS = {"blocks": _render_pine, "table": _render_pine_table}
+
+def _query_pine_format():
+    fmt = request.args.get("format") or "blocks"
+    if fmt not in _PINE_FORMATS:
+        raise _BadQuery(f"Unknown format: {fmt} (allowed: {','.join(_PINE_FORMATS)})")
+    return fmt
+
+def _pine_response(symbols, fmt="blocks"):
+    snap = pin_snapshot(symbols)
+    _, body, etag, budget = _PINE_FORMATS[fmt](snap, symbols)
+    resp = Response(body, mimetype="text/plain")
+    resp.headers["X-Pine-Budget"] = ";".join(f"{k}={v}" for k, v in budget.items())
+    resp.set_etag(etag)
+    resp.last_modified = dt.datetime.fromtimestamp(snap.timestamp, dt.timezone.utc)
+    resp.cache_control.no_cache = True  # المتصفح/TradingView يعيد التحقق → 304 لو لم يتغير شيء
+    return _versioned(resp.make_conditional(request), snap)
+
+@app.route("/all/pine")
+def all_pine():
+    if not POLY_KEY:
+        return _err("Missing POLYGON_API_KEY", 401)
+    try:
+        symbols = _query_symbols()
+        fmt = _query_pine_format()
+    except _BadQuery as e:
+        return _err(str(e), 400)
+    return _pine_response(symbols, fmt)
+
+# ---------------------- /symbol/<sym>/pine -----------------
+@app.route("/symbol/<symbol>/pine")
+def symbol_pine(symbol):
+    """📈 سكربت Pine لرمز واحد فقط (أصغر وأسرع لشارت واحد)"""
+    if not POLY_KEY:
+        return _err("Missing POLYGON_API_KEY", 401)
+    sym = symbol.upper()
+    if sym not in SYMBOLS:
+        return _err("Unknown symbol", 404, sym=sym)
+    try:
+        fmt = _query_pine_format()
+    except _BadQuery as e:
+        return _err(str(e), 400, sym=sym)
+    return _pine_response((sym,), fmt)
 # ============================================================
 # 🧠 تقييم نوع الفرصة (Put / Call Credit) بناءً على ΔOI و Γ
 # ============================================================
@@ -897,89 +2603,317 @@ def evaluate_credit_opportunity(sig_text, delta_oi_calls, delta_oi_puts, delta_g
 # ============================================================
 # 🧾 سجل يومي للفرص المكتشفة (Credit Flow Log)
 # ============================================================
-def log_opportunity(symbol, credit_text, note, flow_signal):
-    log_path = f"{DATA_PATH}/opportunities.json"
-    os.makedirs(DATA_PATH, exist_ok=True)
-    
-    data = {}
-    if os.path.exists(log_path):
-        with open(log_path, "r", encoding="utf-8") as f:
+# 🔹 سجل append-only بصيغة JSONL مقسّم إلى segments (تدوير بالحجم + حد أقصى للعدد)،
+#    مع فهرس صغير {segment: {symbol: [dates]}} لتخطي الملفات غير المطلوبة في الاستعلام.
+OPP_DIR = f"{DATA_PATH}/opportunities"
+OPP_LEGACY_FILE = f"{DATA_PATH}/opportunities.json"  # الصيغة القديمة: تُستورد مرة واحدة
+OPP_SEGMENT_BYTES = int(os.environ.get("OPP_SEGMENT_BYTES", str(4 * 1024 * 1024)))
+OPP_MAX_SEGMENTS = max(1, int(os.environ.get("OPP_MAX_SEGMENTS", "50")))
+OPP_PAGE_LIMIT = 100
+OPP_MAX_LIMIT = 1000
+
+class OpportunityLog:
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._index = None   # {"segments": {name: {"count", "symbols": {sym: [dates]}}}, "last": {sym: [...]}}
+
+    def _index_path(self):
+        return os.path.join(self.root, "index.json")
+
+    def _load(self):
+        if self._index is not None:
+            return self._index
+        index = {"segments": {}, "last": {}}
+        try:
+            with open(self._index_path(), "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[WARN] opportunities index unreadable ({e}) → rebuilding")
+            index = self._rebuild()
+        self._index = index
+        if not index["segments"] and os.path.exists(OPP_LEGACY_FILE):
+            self._import_legacy(index, OPP_LEGACY_FILE)
+        return index
+
+    def _rebuild(self):
+        """يعيد بناء الفهرس من الـ segments نفسها (لو تلف index.json)."""
+        index = {"segments": {}, "last": {}}
+        for name in self._segments_on_disk():
+            index["segments"][name] = {"count": 0, "symbols": {}}
+            with open(os.path.join(self.root, name), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        e = json.loads(line)
+                    except ValueError:
+                        continue   # سطر أخير ناقص بعد توقف مفاجئ
+                    self._index_entry(index, name, e)
+        return index
+
+    def _segments_on_disk(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(n for n in os.listdir(self.root) if n.startswith("opp-") and n.endswith(".jsonl"))
+
+    @staticmethod
+    def _index_entry(index, name, e):
+        meta = index["segments"][name]
+        meta["count"] += 1
+        dates = meta["symbols"].setdefault(e["symbol"], [])
+        day = e["timestamp"][:10]
+        if not dates or dates[-1] != day:
+            dates.append(day)
+        index["last"][e["symbol"]] = [e.get("credit"), e.get("note"), e.get("flow")]
+
+    def _active_segment(self, index):
+        names = sorted(index["segments"])
+        if names:
+            name = names[-1]
+            path = os.path.join(self.root, name)
+            if not os.path.exists(path) or os.path.getsize(path) < OPP_SEGMENT_BYTES:
+                return name
+            seq = int(name[4:-6]) + 1
+        else:
+            seq = 1
+        name = f"opp-{seq:06d}.jsonl"
+        index["segments"][name] = {"count": 0, "symbols": {}}
+        # 🧹 الاحتفاظ بآخر OPP_MAX_SEGMENTS فقط
+        for old in sorted(index["segments"])[:-OPP_MAX_SEGMENTS]:
+            index["segments"].pop(old, None)
             try:
-                data = json.load(f)
-            except:
-                data = {}
+                os.remove(os.path.join(self.root, old))
+            except FileNotFoundError:
+                pass
+        return name
+
+    def _save_index(self, index):
+        tmp = self._index_path() + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, self._index_path())
+
+    def append(self, entries):
+        """
+        يضيف entries [{symbol, credit, note, flow}] في سطر لكل واحد؛ الإدخال المطابق لآخر إدخال
+        لنفس الرمز يُتجاهل (dedupe للتكرار المتتالي). يرجع عدد الأسطر المكتوبة.
+        """
+        with self._lock:
+            return self._append(self._load(), entries)
+
+    def _append(self, index, entries):
+        _ensure_data_dir()
+        os.makedirs(self.root, exist_ok=True)
+        now = dt.datetime.utcnow().isoformat() + "Z"
+        fresh = []
+        for e in entries:
+            key = [e.get("credit"), e.get("note"), e.get("flow")]
+            if index["last"].get(e["symbol"]) == key:
+                continue
+            index["last"][e["symbol"]] = key
+            fresh.append({"timestamp": e.get("timestamp") or now, "symbol": e["symbol"],
+                          "credit": key[0], "note": key[1], "flow": key[2]})
+        if not fresh:
+            return 0
+        name = self._active_segment(index)
+        with open(os.path.join(self.root, name), "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in fresh))
+        for e in fresh:
+            self._index_entry(index, name, e)
+        self._save_index(index)
+        return len(fresh)
+
+    def _import_legacy(self, index, path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+        except Exception as e:
+            print(f"[WARN] legacy opportunities.json unreadable: {e}")
+            return
+        if not isinstance(legacy, dict):
+            return
+        rows = [dict(e, symbol=sym) for sym, items in legacy.items() if isinstance(items, list)
+                for e in items if isinstance(e, dict) and e.get("timestamp")]
+        rows.sort(key=lambda e: e["timestamp"])
+        n = self._append(index, rows)
+        print(f"📥 Imported {n} opportunities from legacy {os.path.basename(path)}")
+
+    def query(self, symbol=None, date_from=None, date_to=None, limit=OPP_PAGE_LIMIT, cursor=None):
+        """
+        يولّد الإدخالات بالترتيب الزمني بدءًا من cursor ("segment:offset") مع التصفية؛
+        آخر عنصر مولَّد هو ("cursor", next_cursor أو None). limit=None → بلا حد.
+        """
+        # نسخة من بيانات الـ segments تحت القفل: append يعدّلها أثناء بث الاستجابة
+        with self._lock:
+            segments = {name: {sym: list(dates) for sym, dates in meta.get("symbols", {}).items()}
+                        for name, meta in self._load()["segments"].items()}
+        names = sorted(segments)
+        start_name, start_off = None, 0
+        if cursor:
+            start_name, _, off = cursor.partition(":")
+            start_off = int(off or 0)
+        sent = 0
+        for name in names:
+            if start_name and name < start_name:
+                continue
+            syms = segments[name]
+            dates = syms.get(symbol, []) if symbol else [d for ds in syms.values() for d in ds]
+            if not any((not date_from or d >= date_from) and (not date_to or d <= date_to) for d in dates):
+                continue
+            path = os.path.join(self.root, name)
+            if not os.path.exists(path):
+                continue
+            with open(path, "rb") as f:
+                if name == start_name:
+                    f.seek(start_off)
+                while True:
+                    line = f.readline()
+                    if not line:
+                        break
+                    if not line.endswith(b"\n"):
+                        break   # سطر يُكتب الآن
+                    try:
+                        e = json.loads(line)
+                    except ValueError:
+                        continue
+                    if symbol and e["symbol"] != symbol:
+                        continue
+                    day = e["timestamp"][:10]
+                    if (date_from and day < date_from) or (date_to and day > date_to):
+                        continue
+                    if sent == limit:
+                        yield ("cursor", f"{name}:{f.tell() - len(line)}")
+                        return
+                    sent += 1
+                    yield e
+        yield ("cursor", None)
+
+OPPORTUNITIES = OpportunityLog(OPP_DIR)
 
-    entry = {
-        "timestamp": dt.datetime.utcnow().isoformat() + "Z",
-        "credit": credit_text,
-        "note": note,
-        "flow": flow_signal
-    }
+# ============================================================
+# 📋 تقرير Credit Monitor (قالب Jinja مُجمَّع مرة واحدة + صفوف مخزنة لكل إصدار رمز)
+# ============================================================
+def _classify_signal(sig_text: str):
+    s = (sig_text or "").strip()
+    if "Bull" in s or "Put" in s or "📈" in s:
+        return "bull", "Credit Put Spread"
+    if "Bear" in s or "Call" in s or "📉" in s:
+        return "bear", "Credit Call Spread"
+    return "neutral", "محايد"
+
+def _report_row(sym, s):
+    """يحسب محتوى صف التقرير لرمز واحد (نفس منطق التقرير الأصلي بدون أي كتابة على القرص)."""
+    # 🟢 حماية ضد العناصر الداخلية المفقودة
+    wcur = s.get("weekly_current") or {}
+    signals = s.get("signals") or {}
+    flow_data = s.get("flow") or {}
+
+    if not isinstance(wcur, dict): wcur = {}
+    if not isinstance(signals, dict): signals = {}
+    if not isinstance(flow_data, dict): flow_data = {}
+
+    wk = wcur.get("picks", []) if isinstance(wcur, dict) else []
+    price = wcur.get("price", 0) if isinstance(wcur, dict) else 0
+    expiry = wcur.get("expiry", "") if isinstance(wcur, dict) else ""
+
+
+    # 🔹 معالجة آمنة لتفادي الخطأ (list has no attribute 'get')
+    sig_text = "⚪ Neutral"
+    try:
+        sig_data = s.get("signals", {})
+        if isinstance(sig_data, list):
+            sig_data = sig_data[0] if sig_data and isinstance(sig_data[0], dict) else {}
 
-    data.setdefault(symbol, []).append(entry)
+        curr = sig_data.get("current", {})
+        if isinstance(curr, list):
+            curr = curr[0] if curr and isinstance(curr[0], dict) else {}
 
-    with open(log_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        sig_block = curr.get("signal", {})
+        if isinstance(sig_block, list):
+            sig_block = sig_block[0] if sig_block and isinstance(sig_block[0], dict) else {}
 
+        sig_text = sig_block.get("signal", "⚪ Neutral")
+    except Exception as e:
+        print(f"[WARN] Signal parse error for {sym}: {e}")
+        sig_text = "⚪ Neutral"
 
-@app.route("/report/pine/all")
-def report_pine_all():
-    """تقرير شامل لجميع الشركات (Credit Monitor Report) مع إصلاح تلقائي للبيانات وحماية من تلف الملفات"""
 
-    try:
-        now_hhmm = dt.datetime.now().strftime("%Y-%m-%d %H:%M")
 
-        # 🧠 تحميل البيانات بأمان
-        with open(f"{DATA_PATH}/all.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
+    # 🔹 تحليل الصفقة المقترحة
+    credit_text = "—"
+    note = "—"
 
-        # 🩵 حماية من الخطأ إذا الملف كان list بدل dict
-        if isinstance(data, list):
-            print("[WARN] all.json is list, converting to dict structure...")
-            if len(data) > 0 and isinstance(data[0], dict):
-                data = data[0]
-            else:
-                data = {"updated": None, "symbols": [], "data": {}}
-
-        # 🩶 إصلاح إضافي لو كانت المفاتيح مفقودة
-        if not isinstance(data, dict):
-            print("[WARN] all.json invalid structure, resetting to safe defaults...")
-            data = {"updated": None, "symbols": [], "data": {}}
-
-        # 🩷 محاولة قراءة المفاتيح الأساسية
-        updated_iso = data.get("updated") or ""
-        updated_display = updated_iso if updated_iso else "غير متوفر"
-        symbols = data.get("symbols", [])
-        all_data = data.get("data", {})
-
-        # 💚 إصلاح تلقائي لو كانت البيانات غير منظمة (list بدل dict)
-        if isinstance(all_data, list):
-            print("[WARN] all_data was list, fixing structure...")
-            fixed = {}
-            for entry in all_data:
-                if isinstance(entry, dict) and "symbol" in entry:
-                    fixed[entry["symbol"]] = entry
-            all_data = fixed
-
-        # -----------------------------------------------
-        # 🟢 من هنا يبدأ الكود الأساسي (داخل try)
-        # -----------------------------------------------
-        def classify(sig_text: str):
-            s = (sig_text or "").strip()
-            if "Bull" in s or "Put" in s or "📈" in s:
-                return "bull", "Credit Put Spread"
-            if "Bear" in s or "Call" in s or "📉" in s:
-                return "bear", "Credit Call Spread"
-            return "neutral", "محايد"
-
-        html = f"""
+    # 🔹 تحليل الفرصة حسب البيانات
+    sig = s.get("signals", {}).get("current", {}).get("signal", {})
+    sig_text = sig.get("signal", "⚪ Neutral")
+    
+    today = s.get("signals", {}).get("current", {}).get("today", {})
+    base = s.get("signals", {}).get("current", {}).get("base", {})
+
+    delta_oi_calls = (today.get("calls", 0) - base.get("calls", 0)) / max(base.get("calls", 1), 1)
+    delta_oi_puts  = (today.get("puts", 0) - base.get("puts", 0)) / max(base.get("puts", 1), 1)
+    delta_gamma    = 0
+    
+    wk = s.get("weekly_current", {}).get("top7", [])
+    if wk:
+        gammas = [x.get("net_gamma", 0) for x in wk if isinstance(x, dict)]
+        if gammas:
+            delta_gamma = sum(gammas) / len(gammas)
+
+    # 🔍 تقييم الفرصة الذكية
+    credit_text, note = evaluate_credit_opportunity(sig_text, delta_oi_calls, delta_oi_puts, delta_gamma)
+    
+    
+    if wk and price:
+        nearest = min(wk, key=lambda x: abs(x.get("strike", 0) - price))
+        base_strike = nearest.get("strike", 0)
+        net_gamma = nearest.get("net_gamma", 0)
+
+        if "📈" in sig_text or "Bull" in sig_text:
+            short_leg = base_strike
+            long_leg = base_strike - 5
+            credit_text = f"📈 Put Credit Spread – بيع {short_leg}P / شراء {long_leg}P (تنتهي {expiry})"
+            note = "📈 دعم قوي أسفل السعر – احتمال ارتداد" if net_gamma > 0 else "⚠️ مراقبة الحركة – Gamma ضعيف حاليًا"
+
+        elif "📉" in sig_text or "Bear" in sig_text:
+            short_leg = base_strike
+            long_leg = base_strike + 5
+            credit_text = f"📉 Call Credit Spread – بيع {short_leg}C / شراء {long_leg}C (تنتهي {expiry})"
+            note = "📉 Gamma سلبي قوي – ضغط بيعي محتمل" if net_gamma < 0 else "⚠️ تأكيد الاتجاه غدًا بعد تحديث OI"
+        else:
+            note = "⚪ إشارة محايدة – لم يتأكد الاتجاه بعد"
+
+    # 🔹 نطاق الجاما (Top7)
+    if wk:
+        gmin = min(wk, key=lambda x: x.get("strike", float("inf"))).get("strike", "")
+        gmax = max(wk, key=lambda x: x.get("strike", float("-inf"))).get("strike", "")
+        range_text = f"{gmin} → {gmax}"
+    else:
+        range_text = "—"
+
+    # 🔹 تصنيف الإشارة
+    cls, typ = _classify_signal(sig_text)
+
+    # 🔹 اتجاه السيولة (Flow)
+    flow_signal = s.get("flow", {}).get("flow_signal", "—")
+    flow_color = "neutral"
+    if "PUT" in flow_signal or "📈" in flow_signal:
+        flow_color = "bull"
+    elif "CALL" in flow_signal or "📉" in flow_signal:
+        flow_color = "bear"
+
+    return {"sym": sym, "sig_text": sig_text, "cls": cls, "typ": typ, "range_text": range_text,
+            "credit_text": credit_text, "note": note, "flow_signal": flow_signal, "flow_color": flow_color}
+
+_REPORT_TEMPLATE = app.jinja_env.from_string("""
         <html dir="rtl" lang="ar">
         <head>
         <meta charset="utf-8">
-        <title>تقرير Bassam GEX Pro v7.0 – مراقبة فرص Credit – {now_hhmm}</title>
+        <title>تقرير Bassam GEX Pro v7.0 – مراقبة فرص Credit – {{ now_hhmm }}</title>
         <style>
             @import url('https://fonts.googleapis.com/css2?family=Tajawal:wght@400;500;700&display=swap');
-            :root {{
+            :root {
                 --bg: #0a0a0a;
                 --panel: #141414;
                 --grid: #222;
@@ -990,43 +2924,43 @@ def report_pine_all():
                 --bull: #13f29a;
                 --bear: #ff5757;
                 --neutral: #bdbdbd;
-            }}
-            * {{ box-sizing: border-box; }}
-            body {{
+            }
+            * { box-sizing: border-box; }
+            body {
                 font-family: "Tajawal", system-ui, -apple-system, Segoe UI, Roboto, sans-serif;
                 background-color: var(--bg);
                 color: var(--text);
                 padding: 24px;
                 line-height: 1.65;
-            }}
-            .wrap {{ max-width: 1200px; margin: 0 auto; }}
-            h1 {{
+            }
+            .wrap { max-width: 1200px; margin: 0 auto; }
+            h1 {
                 color: var(--accent);
                 text-align: center;
                 margin: 0 0 10px 0;
                 font-size: 26px;
                 font-weight: 700;
-            }}
-            .sub {{
+            }
+            .sub {
                 text-align: center;
                 color: var(--muted);
                 margin-bottom: 24px;
                 font-size: 14px;
-            }}
-            .card {{
+            }
+            .card {
                 background: var(--panel);
                 border: 1px solid var(--grid);
                 border-radius: 14px;
                 padding: 14px;
                 margin-bottom: 18px;
-            }}
-            table {{
+            }
+            table {
                 width: 100%;
                 border-collapse: collapse;
                 overflow: hidden;
                 border-radius: 10px;
-            }}
-            thead th {{
+            }
+            thead th {
                 background-color: #101010;
                 color: var(--accent);
                 font-weight: 600;
@@ -1034,41 +2968,41 @@ def report_pine_all():
                 padding: 10px 12px;
                 text-align: center;
                 white-space: nowrap;
-            }}
-            tbody td {{
+            }
+            tbody td {
                 border-bottom: 1px solid var(--grid);
                 padding: 10px 12px;
                 text-align: center;
                 vertical-align: middle;
-            }}
-            tbody tr:nth-child(even) {{ background-color: var(--grid-soft); }}
-            .chip {{
+            }
+            tbody tr:nth-child(even) { background-color: var(--grid-soft); }
+            .chip {
                 display: inline-block;
                 padding: 4px 10px;
                 border-radius: 999px;
                 font-weight: 600;
                 font-size: 12px;
-            }}
-            .bull {{ color: var(--bull); }}
-            .bear {{ color: var(--bear); }}
-            .neutral {{ color: var(--neutral); }}
-            .chip.bull {{ border: 1px solid var(--bull); }}
-            .chip.bear {{ border: 1px solid var(--bear); }}
-            .chip.neutral {{ border: 1px solid var(--neutral); }}
-            .muted {{ color: var(--muted); font-size: 12px; }}
-            footer {{
+            }
+            .bull { color: var(--bull); }
+            .bear { color: var(--bear); }
+            .neutral { color: var(--neutral); }
+            .chip.bull { border: 1px solid var(--bull); }
+            .chip.bear { border: 1px solid var(--bear); }
+            .chip.neutral { border: 1px solid var(--neutral); }
+            .muted { color: var(--muted); font-size: 12px; }
+            footer {
                 text-align: center;
                 color: var(--muted);
                 margin-top: 22px;
                 font-size: 13px;
-            }}
+            }
         </style>
         </head>
         <body>
         <div class="wrap">
-            <h1>تقرير Bassam GEX Pro v7.0 – مراقبة فرص  – {now_hhmm}</h1>
+            <h1>تقرير Bassam GEX Pro v7.0 – مراقبة فرص  – {{ now_hhmm }}</h1>
             <div class="sub">
-                🔄 آخر تحديث من البيانات: <b>{updated_display}</b>
+                🔄 آخر تحديث من البيانات: <b>{{ updated_display }}</b>
             </div>
 
             <div class="card">
@@ -1085,254 +3019,435 @@ def report_pine_all():
 
                         </tr>
                     </thead>
-        """
-        html += "<tbody>"
-
-        # ========================================
-        # 🔹 توليد صفوف التقرير (HTML Table Rows)
-        # ========================================
-        # تأكد أن all_data قاموس
-        if isinstance(all_data, list):
-            print("[WARN] all_data was list, resetting...")
-            all_data = {}
-        
-        for sym in symbols:
-            s = all_data.get(sym) if isinstance(all_data, dict) else None
-            if not isinstance(s, dict):
-                print(f"[WARN] {sym} invalid data type ({type(s)}), resetting...")
-                s = {}
-
-            # 🩵 حماية ذكية ضد بيانات غير صالحة (list أو dict)
-            if isinstance(s, list):
-                if len(s) > 0 and isinstance(s[0], dict):
-                    s = s[0]
-                else:
-                    # ❗ في حال بيانات السهم فارغة أو خاطئة
-                    print(f"[WARN] {sym} has invalid data structure → resetting.")
-                    s = {}
-
-            elif not isinstance(s, dict):
-                print(f"[WARN] {sym} data type = {type(s)}, expected dict → resetting.")
-                s = {}
-
-            # 🟢 حماية ضد العناصر الداخلية المفقودة
-            wcur = s.get("weekly_current") or {}
-            signals = s.get("signals") or {}
-            flow_data = s.get("flow") or {}
-
-            if not isinstance(wcur, dict): wcur = {}
-            if not isinstance(signals, dict): signals = {}
-            if not isinstance(flow_data, dict): flow_data = {}
-
-            wk = wcur.get("picks", []) if isinstance(wcur, dict) else []
-            price = wcur.get("price", 0) if isinstance(wcur, dict) else 0
-            expiry = wcur.get("expiry", "") if isinstance(wcur, dict) else ""
-
-
-            # 🔹 معالجة آمنة لتفادي الخطأ (list has no attribute 'get')
-            sig_text = "⚪ Neutral"
-            try:
-                sig_data = s.get("signals", {})
-                if isinstance(sig_data, list):
-                    sig_data = sig_data[0] if sig_data and isinstance(sig_data[0], dict) else {}
-
-                curr = sig_data.get("current", {})
-                if isinstance(curr, list):
-                    curr = curr[0] if curr and isinstance(curr[0], dict) else {}
-
-                sig_block = curr.get("signal", {})
-                if isinstance(sig_block, list):
-                    sig_block = sig_block[0] if sig_block and isinstance(sig_block[0], dict) else {}
-
-                sig_text = sig_block.get("signal", "⚪ Neutral")
-            except Exception as e:
-                print(f"[WARN] Signal parse error for {sym}: {e}")
-                sig_text = "⚪ Neutral"
-
-
-
-            # 🔹 تحليل الصفقة المقترحة
-            credit_text = "—"
-            note = "—"
-
-            # 🔹 تحليل الفرصة حسب البيانات
-            sig = s.get("signals", {}).get("current", {}).get("signal", {})
-            sig_text = sig.get("signal", "⚪ Neutral")
-            
-            today = s.get("signals", {}).get("current", {}).get("today", {})
-            base = s.get("signals", {}).get("current", {}).get("base", {})
-
-            delta_oi_calls = (today.get("calls", 0) - base.get("calls", 0)) / max(base.get("calls", 1), 1)
-            delta_oi_puts  = (today.get("puts", 0) - base.get("puts", 0)) / max(base.get("puts", 1), 1)
-            delta_gamma    = 0
-            
-            wk = s.get("weekly_current", {}).get("top7", [])
-            if wk:
-                gammas = [x.get("net_gamma", 0) for x in wk if isinstance(x, dict)]
-                if gammas:
-                    delta_gamma = sum(gammas) / len(gammas)
-
-            # 🔍 تقييم الفرصة الذكية
-            credit_text, note = evaluate_credit_opportunity(sig_text, delta_oi_calls, delta_oi_puts, delta_gamma)
-            
-            
-            if wk and price:
-                nearest = min(wk, key=lambda x: abs(x.get("strike", 0) - price))
-                base_strike = nearest.get("strike", 0)
-                net_gamma = nearest.get("net_gamma", 0)
-
-                if "📈" in sig_text or "Bull" in sig_text:
-                    short_leg = base_strike
-                    long_leg = base_strike - 5
-                    credit_text = f"📈 Put Credit Spread – بيع {short_leg}P / شراء {long_leg}P (تنتهي {expiry})"
-                    note = "📈 دعم قوي أسفل السعر – احتمال ارتداد" if net_gamma > 0 else "⚠️ مراقبة الحركة – Gamma ضعيف حاليًا"
-
-                elif "📉" in sig_text or "Bear" in sig_text:
-                    short_leg = base_strike
-                    long_leg = base_strike + 5
-                    credit_text = f"📉 Call Credit Spread – بيع {short_leg}C / شراء {long_leg}C (تنتهي {expiry})"
-                    note = "📉 Gamma سلبي قوي – ضغط بيعي محتمل" if net_gamma < 0 else "⚠️ تأكيد الاتجاه غدًا بعد تحديث OI"
-                else:
-                    note = "⚪ إشارة محايدة – لم يتأكد الاتجاه بعد"
-
-            # 🔹 نطاق الجاما (Top7)
-            if wk:
-                gmin = min(wk, key=lambda x: x.get("strike", float("inf"))).get("strike", "")
-                gmax = max(wk, key=lambda x: x.get("strike", float("-inf"))).get("strike", "")
-                range_text = f"{gmin} → {gmax}"
-            else:
-                range_text = "—"
-
-            # 🔹 تصنيف الإشارة
-            cls, typ = classify(sig_text)
-            sig_html = f'<span class="chip {cls}">{sig_text}</span>'
-
-            # 🔹 صف الجدول
-            # 🔹 اتجاه السيولة (Flow)
-            flow_signal = s.get("flow", {}).get("flow_signal", "—")
-            flow_color = "neutral"
-            if "PUT" in flow_signal or "📈" in flow_signal:
-                flow_color = "bull"
-            elif "CALL" in flow_signal or "📉" in flow_signal:
-                flow_color = "bear"
-
-            flow_html = f'<span class="chip {flow_color}">{flow_signal}</span>'
-            # 🔹 حفظ السجل اليومي
-            log_opportunity(sym, credit_text, note, flow_signal)
-
-            # 🔹 صف الجدول مع عمود جديد لاتجاه السيولة
-            html += f"""
-                <tr>
-                    <td><b>{sym}</b></td>
-                    <td>{sig_html}</td>
-                    <td class="{cls}">{typ}</td>
-                    <td>{range_text}</td>
-                    <td>{credit_text}</td>
-                    <td>{note}</td>
-                    <td>{flow_html}</td>
-                </tr>
-            """
-
-
-        # ✅ إغلاق HTML بالكامل
-        html += f"""
+        <tbody>{% for row in rows %}{{ row }}{% endfor %}
                 </tbody>
             </table>
             <div class="muted">* نطاق الجاما محسوب من أعلى 7 مستويات أسبوعية.</div>
         </div>
 
-        <footer>© {dt.datetime.now().year} Bassam Al-Faifi — All Rights Reserved</footer>
+        <footer>© {{ year }} Bassam Al-Faifi — All Rights Reserved</footer>
     </div>
     </body>
     </html>
-        """
-
-        # 🔹 حفظ البيانات بعد توليد التقرير مع توقيت الرياض
-        now = dt.datetime.now(dt.timezone(dt.timedelta(hours=3)))
-        updated_time = now.strftime("%Y-%m-%d %H:%M:%S")
-        
-        os.makedirs(DATA_PATH, exist_ok=True)
-        with open(f"{DATA_PATH}/all.json", "w", encoding="utf-8") as f:
-            json.dump({
-                "updated": updated_time,
-                "symbols": SYMBOLS,
-                "data": all_data
-            }, f, ensure_ascii=False, indent=2)
-
+""")
 
+_REPORT_ROW_TEMPLATE = app.jinja_env.from_string("""
+                <tr>
+                    <td><b>{{ r.sym }}</b></td>
+                    <td><span class="chip {{ r.cls }}">{{ r.sig_text }}</span></td>
+                    <td class="{{ r.cls }}">{{ r.typ }}</td>
+                    <td>{{ r.range_text }}</td>
+                    <td>{{ r.credit_text }}</td>
+                    <td>{{ r.note }}</td>
+                    <td><span class="chip {{ r.flow_color }}">{{ r.flow_signal }}</span></td>
+                </tr>
+""")
+
+_REPORT_ROWS = {}   # symbol → (symbol_version, row dict, html fragment)
+
+def _report_fragment(snap, sym):
+    version = snap.symbol_versions.get(sym)
+    cached = _REPORT_ROWS.get(sym)
+    if not cached or cached[0] != version:
+        row = _report_row(sym, snap.get(sym))
+        cached = _REPORT_ROWS[sym] = (version, row, Markup(_REPORT_ROW_TEMPLATE.render(r=row)))
+    return cached
+
+def _log_published_opportunities(snap, symbols):
+    """🧾 سجل الفرص يُكتب عند النشر (مرة لكل إصدار) بدل كل عرض للتقرير."""
+    entries = []
+    for sym in symbols:
+        if snap.get(sym):
+            row = _report_fragment(snap, sym)[1]
+            entries.append({"symbol": sym, "credit": row["credit_text"], "note": row["note"],
+                            "flow": row["flow_signal"]})
+    try:
+        OPPORTUNITIES.append(entries)
+    except OSError as e:
+        print(f"[WARN] opportunity log append failed: {e}")
 
-        return Response(html, mimetype="text/html")
+@app.route("/report/pine/all")
+def report_pine_all():
+    """تقرير شامل لجميع الشركات (Credit Monitor Report) من الـ Snapshot في الذاكرة — بلا أي كتابة"""
+    try:
+        snap = pin_snapshot(wait=False)
+        now_hhmm = dt.datetime.now().strftime("%Y-%m-%d %H:%M")
+        updated_display = snap.updated if snap.data else "غير متوفر"
+        rows = [_report_fragment(snap, sym)[2] for sym in SYMBOLS if snap.get(sym)]
     except Exception as e:
         return jsonify({"error": str(e)})
+    stream = _REPORT_TEMPLATE.generate(now_hhmm=now_hhmm, updated_display=updated_display,
+                                       rows=rows, year=dt.datetime.now().year)
+    return _versioned(Response(stream, mimetype="text/html"), snap)
+
+
+# ---------------------- Precomputed JSON ------------------
+# 🔹 الـ payloads تُبنى وتُسلسَل مرة واحدة لكل إصدار Snapshot (+ gzip / brotli مسبقًا)،
+#    والطلب يخدم bytes جاهزة مع ETag ولا يلمس Polygon أبدًا.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+JSON_GZIP_LEVEL = int(os.environ.get("JSON_GZIP_LEVEL", "6"))
+JSON_CACHE_MAX = 256  # مفاتيح (endpoint, symbols, fields) المخزنة قبل التفريغ
+_JSON_CACHE = {}   # key → (version, {encoding: bytes}, etag)
+_JSON_LOCK = threading.Lock()
+
+def _snapshot_utc(snap):
+    return dt.datetime.utcfromtimestamp(snap.timestamp).isoformat() + "Z"
+
+def _to_obj(picks):
+    out = []
+    for (s, ng, iv) in picks[:LEVELS_K]:
+        out.append({"strike": s, "net_gamma": ng, "iv": iv})
+    return out
+
+def _all_entry(data):
+    return {
+        "weekly_current": {
+            "expiry": data["weekly_current"].get("expiry"),
+            "price":  data["weekly_current"].get("price"),
+            "top7":   _to_obj(data["weekly_current"].get("picks", []))
+        },
+        "weekly_next": {
+            "expiry": data["weekly_next"].get("expiry"),
+            "price":  data["weekly_next"].get("price"),
+            "top7":   _to_obj(data["weekly_next"].get("picks", []))
+        },
+        "monthly": {
+            "expiry": data["monthly"].get("expiry"),
+            "price":  data["monthly"].get("price"),
+            "top7":   _to_obj(data["monthly"].get("picks", []))
+        },
+        "em": data.get("em"),
+        "signals": data.get("signals"),
+        "earnings_date": data.get("earnings_date"),
+        "timestamp": data["timestamp"]
+    }
 
+# 🔹 لكل endpoint: دالة تبني كائن الرمز + الحقول المسموح بها في ?fields=
+ALL_FIELDS = ("weekly_current", "weekly_next", "monthly", "em", "signals", "earnings_date", "timestamp")
+SYMBOL_FIELDS = ALL_FIELDS + ("flow", "term")
+_JSON_VIEWS = {
+    "all":     (_all_entry, ALL_FIELDS),
+    "signals": (lambda d: d.get("signals", {}), ("current", "next")),
+    "em":      (lambda d: d.get("em", {}), ("current", "next")),
+}
+
+def _project(obj, fields):
+    if not fields or not isinstance(obj, dict):
+        return obj
+    return {k: obj.get(k) for k in fields}
+
+def _aggregate_payload(kind, snap, symbols, fields):
+    entry_fn = _JSON_VIEWS[kind][0]
+    out = {}
+    for sym in symbols:
+        d = snap.get(sym)
+        if not d: continue
+        out[sym] = _project(entry_fn(d), fields)
+    payload = {"status": "OK", "version": snap.version}
+    if kind == "all":
+        payload["symbols"] = list(symbols)
+    payload["updated"] = _snapshot_utc(snap)
+    payload["data"] = out
+    return payload
+
+def _symbol_payload(sym, snap, fields):
+    data = snap.get(sym)
+    obj = _all_entry(data)
+    obj["flow"] = data.get("flow")
+    obj["term"] = data.get("term")
+    return {"status": "OK", "version": snap.symbol_versions.get(sym), "symbol": sym,
+            "updated": _snapshot_utc(snap), "data": _project(obj, fields or ALL_FIELDS)}
+
+class _BadQuery(ValueError):
+    pass
+
+def _query_list(name):
+    raw = request.args.get(name)
+    if raw is None:
+        return None
+    return [x.strip() for x in raw.split(",") if x.strip()] or None
+
+def _query_symbols():
+    """?symbols=AAPL,SPY → tuple مرتبة كما طُلبت؛ رمز غير معروف → 400."""
+    syms = _query_list("symbols")
+    if syms is None:
+        return tuple(SYMBOLS)
+    syms = tuple(dict.fromkeys(x.upper() for x in syms))
+    unknown = [x for x in syms if x not in SYMBOLS]
+    if unknown:
+        raise _BadQuery(f"Unknown symbols: {','.join(unknown)}")
+    return syms
+
+def _query_fields(allowed):
+    """?fields=em,signals → tuple؛ حقل غير معروف → 400."""
+    fields = _query_list("fields")
+    if fields is None:
+        return None
+    fields = tuple(dict.fromkeys(fields))
+    unknown = [x for x in fields if x not in allowed]
+    if unknown:
+        raise _BadQuery(f"Unknown fields: {','.join(unknown)} (allowed: {','.join(allowed)})")
+    return fields
+
+def _encode_json(payload):
+    """يسلسل الـ payload مرة واحدة ويجهّز كل الترميزات المدعومة."""
+    raw = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    bodies = {"identity": raw, "gzip": gzip.compress(raw, JSON_GZIP_LEVEL, mtime=0)}
+    if brotli is not None:
+        bodies["br"] = brotli.compress(raw)
+    return bodies, hashlib.sha1(raw).hexdigest()[:20]
+
+def _cached_json(key, version, build):
+    entry = _JSON_CACHE.get(key)
+    if entry and entry[0] == version:
+        return entry
+    with _JSON_LOCK:
+        entry = _JSON_CACHE.get(key)
+        if not entry or entry[0] != version:
+            if len(_JSON_CACHE) >= JSON_CACHE_MAX:
+                _JSON_CACHE.clear()
+            bodies, etag = _encode_json(build())
+            entry = _JSON_CACHE[key] = (version, bodies, etag)
+    return entry
+
+def _json_response(entry, snap):
+    """يختار الترميز حسب Accept-Encoding ويرجع bytes جاهزة (304 لو ETag مطابق)."""
+    _, bodies, etag = entry
+    enc = request.accept_encodings.best_match([e for e in ("br", "gzip") if e in bodies]) or "identity"
+    resp = Response(bodies[enc], mimetype="application/json")
+    if enc != "identity":
+        resp.headers["Content-Encoding"] = enc
+    resp.vary.add("Accept-Encoding")
+    resp.set_etag(etag if enc == "identity" else f"{etag}-{enc}")
+    resp.last_modified = dt.datetime.fromtimestamp(snap.timestamp, dt.timezone.utc)
+    resp.cache_control.no_cache = True
+    return _versioned(resp.make_conditional(request), snap)
+
+def _serve_json(kind):
+    """endpoint تجميعي مع ?symbols= و ?fields= — الرموز غير المطلوبة لا تُحدَّث ولا تُبنى."""
+    try:
+        symbols = _query_symbols()
+        fields = _query_fields(_JSON_VIEWS[kind][1])
+    except _BadQuery as e:
+        return _err(str(e), 400)
+    snap = pin_snapshot(symbols, wait=False)
+    entry = _cached_json((kind, symbols, fields), snap.version,
+                         lambda: _aggregate_payload(kind, snap, symbols, fields))
+    return _json_response(entry, snap)
 
 # ---------------------- /signals/json ----------------------
 @app.route("/signals/json")
 def signals_json():
     if not POLY_KEY: return _err("Missing POLYGON_API_KEY", 401)
-    out = {}
-    for sym in SYMBOLS:
-        d = get_symbol_data(sym)
-        if not d: continue
-        out[sym] = d.get("signals", {})
-    return jsonify({"status": "OK", "updated": dt.datetime.utcnow().isoformat()+"Z", "data": out})
+    return _serve_json("signals")
 
 # ---------------------- /all/json --------------------------
 @app.route("/all/json")
 def all_json():
     if not POLY_KEY:
         return _err("Missing POLYGON_API_KEY", 401)
-    all_data = {}
-    for sym in SYMBOLS:
-        data = get_symbol_data(sym)
-        if not data:
-            continue
+    return _serve_json("all")
 
-        def _to_obj(picks):
-            out = []
-            for (s, ng, iv) in picks[:7]:
-                out.append({"strike": s, "net_gamma": ng, "iv": iv})
-            return out
-
-        all_data[sym] = {
-            "weekly_current": {
-                "expiry": data["weekly_current"].get("expiry"),
-                "price":  data["weekly_current"].get("price"),
-                "top7":   _to_obj(data["weekly_current"].get("picks", []))
-            },
-            "weekly_next": {
-                "expiry": data["weekly_next"].get("expiry"),
-                "price":  data["weekly_next"].get("price"),
-                "top7":   _to_obj(data["weekly_next"].get("picks", []))
-            },
-            "monthly": {
-                "expiry": data["monthly"].get("expiry"),
-                "price":  data["monthly"].get("price"),
-                "top7":   _to_obj(data["monthly"].get("picks", []))
-            },
-            "em": data.get("em"),
-            "signals": data.get("signals"),
-            "earnings_date": data.get("earnings_date"),
-            "timestamp": data["timestamp"]
-        }
-    return jsonify({
+# ---------------------- /symbol/<sym>/json -----------------
+@app.route("/symbol/<symbol>/json")
+def symbol_json(symbol):
+    """📄 رمز واحد فقط (يُحدَّث وحده) مع ?fields= — يشمل flow و term عند الطلب"""
+    if not POLY_KEY:
+        return _err("Missing POLYGON_API_KEY", 401)
+    sym = symbol.upper()
+    if sym not in SYMBOLS:
+        return _err("Unknown symbol", 404, sym=sym)
+    try:
+        fields = _query_fields(SYMBOL_FIELDS)
+    except _BadQuery as e:
+        return _err(str(e), 400, sym=sym)
+    snap = pin_snapshot([sym])
+    if not snap.get(sym):
+        return _err("No data", 502, sym=sym)
+    entry = _cached_json(("symbol", sym, fields), snap.symbol_versions.get(sym),
+                         lambda: _symbol_payload(sym, snap, fields))
+    return _json_response(entry, snap)
+
+# ---------------------- /term/<symbol> ---------------------
+@app.route("/term/<symbol>")
+def term_json(symbol):
+    """📈 هيكل Gamma الزمني: picks + مجاميع لكل expiry حتى TERM_HORIZON_DAYS"""
+    if not POLY_KEY:
+        return _err("Missing POLYGON_API_KEY", 401)
+    sym = symbol.upper()
+    if sym not in SYMBOLS:
+        return _err("Unknown symbol", 404, sym=sym)
+    snap = pin_snapshot([sym])
+    data = snap.get(sym)
+    if not data:
+        return _err("No data", 502, sym=sym)
+    term = []
+    for t in data.get("term") or []:
+        row = dict(t)
+        row["picks"] = [{"strike": s, "net_gamma": ng, "iv": iv} for (s, ng, iv) in t.get("picks", [])]
+        term.append(row)
+    return _versioned(jsonify({
         "status": "OK",
-        "symbols": SYMBOLS,
-        "updated": dt.datetime.utcnow().isoformat() + "Z",
-        "data": all_data
-    })
+        "version": snap.version,
+        "symbol": sym,
+        "horizon_days": TERM_HORIZON_DAYS,
+        "price": data["weekly_current"].get("price"),
+        "term": term,
+        "timestamp": data["timestamp"]
+    }), snap)
+
+# ---------------------- /history --------------------------
+def _query_time(name, default):
+    """?from= / ?to= → epoch: رقم epoch أو تاريخ/وقت ISO (بدون منطقة = UTC)."""
+    raw = request.args.get(name)
+    if not raw:
+        return default
+    try:
+        return float(raw)
+    except ValueError:
+        pass
+    try:
+        t = dt.datetime.fromisoformat(raw)
+    except ValueError:
+        raise _BadQuery(f"Invalid {name}: {raw}")
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=dt.timezone.utc)
+    return t.timestamp()
+
+@app.route("/history/<sym>")
+def history_json(sym):
+    """🗂️ تاريخ مقاييس السترايك: ?from= &to= (epoch أو ISO، الافتراضي آخر 24 ساعة) &expiry= &limit="""
+    sym = sym.upper()
+    if sym not in SYMBOLS:
+        return _err("Unknown symbol", 404, sym=sym)
+    now = time.time()
+    try:
+        t1 = _query_time("to", now)
+        t0 = _query_time("from", t1 - 86400)
+        expiries = _query_list("expiry")
+        ordinals = [dt.date.fromisoformat(x).toordinal() for x in expiries] if expiries else None
+        limit = min(HISTORY_MAX_FRAMES, max(1, int(request.args.get("limit") or HISTORY_MAX_FRAMES)))
+    except (_BadQuery, ValueError) as e:
+        return _err(str(e), 400, sym=sym)
+
+    frames = []
+    for ts, cols in HISTORY.query(sym, t0, t1, limit):
+        exp = cols["expiry"]
+        starts = np.r_[0, np.flatnonzero(np.diff(exp)) + 1]
+        stops = np.r_[starts[1:], len(exp)]
+        out = {}
+        for a, b in zip(starts.tolist(), stops.tolist()):
+            if ordinals is not None and int(exp[a]) not in ordinals:
+                continue
+            out[dt.date.fromordinal(int(exp[a])).isoformat()] = {
+                name: np.round(cols[name][a:b].astype(np.float64), 6).tolist()
+                for name, _ in _HIST_COLUMNS[1:]
+            }
+        frames.append({"timestamp": ts, "expiries": out})
+    return jsonify({"status": "OK", "symbol": sym, "from": t0, "to": t1, "count": len(frames), "frames": frames})
 
 # ---------------------- /em/json ---------------------------
 @app.route("/em/json")
 def em_json():
     if not POLY_KEY:
         return _err("Missing POLYGON_API_KEY", 401)
-    out = {}
-    for sym in SYMBOLS:
-        d = get_symbol_data(sym)
-        if not d: continue
-        out[sym] = d.get("em", {})
-    return jsonify({"status": "OK", "updated": dt.datetime.utcnow().isoformat()+"Z", "data": out})
+    return _serve_json("em")
+
+# ---------------------- /stream (SSE) ---------------------
+# 🔹 مع gevent (الافتراضي) كل مشترك greenlet ينتظر على Condition واحد (بلا polling) — آلاف الاتصالات
+#    الخاملة بدون thread لكل اتصال. في SERVER_MODE=threaded كل اتصال يشغل thread، لذلك الحدود أصغر:
+#    /stream بعد STREAM_MAX_CLIENTS → 503 + Retry-After + Link إلى /stream/poll، و /stream/poll بعد
+#    POLL_MAX_WAITERS يرد فورًا بدل الانتظار. عمر الاتصال محدود STREAM_MAX_SECONDS ثم يعيد العميل
+#    الاتصال بـ Last-Event-ID فلا تضيع أحداث.
+STREAM_MAX_CLIENTS = int(os.environ.get("STREAM_MAX_CLIENTS", "5000" if ASYNC_SERVER else "8"))
+POLL_MAX_WAITERS   = int(os.environ.get("POLL_MAX_WAITERS", "5000" if ASYNC_SERVER else "16"))
+STREAM_MAX_SECONDS = int(os.environ.get("STREAM_MAX_SECONDS", "300"))
+STREAM_HEARTBEAT   = int(os.environ.get("STREAM_HEARTBEAT", "15"))
+STREAM_RETRY_MS    = int(os.environ.get("STREAM_RETRY_MS", "3000"))
+POLL_TIMEOUT       = int(os.environ.get("POLL_TIMEOUT", "25"))
+_STREAM_SLOTS = threading.BoundedSemaphore(STREAM_MAX_CLIENTS)
+_POLL_SLOTS = threading.BoundedSemaphore(POLL_MAX_WAITERS)
+
+def _event_obj(event, symbols):
+    version, updated, diffs = event
+    if symbols is not None:
+        diffs = {s: d for s, d in diffs.items() if s in symbols}
+    return {"version": version, "updated": updated, "symbols": diffs}
+
+def _int_arg(raw):
+    try:
+        return int(raw) if raw not in (None, "") else None
+    except ValueError:
+        raise _BadQuery(f"Invalid version: {raw}")
+
+@app.route("/stream")
+def stream():
+    """📡 SSE: حدث لكل Snapshot جديد فيه فروقات (picks / signal / EM) — ?symbols= للتصفية"""
+    try:
+        symbols = set(_query_symbols()) if request.args.get("symbols") else None
+        last_id = _int_arg(request.headers.get("Last-Event-ID") or request.args.get("since"))
+    except _BadQuery as e:
+        return _err(str(e), 400)
+    if last_id is None:
+        last_id = _FEED.latest()
+    if not _STREAM_SLOTS.acquire(blocking=False):
+        resp = _err(f"Too many stream clients (max {STREAM_MAX_CLIENTS}); use /stream/poll", 503)
+        resp.headers["Retry-After"] = str(STREAM_RETRY_MS // 1000 or 1)
+        resp.headers["Link"] = f'</stream/poll?since={last_id}>; rel="alternate"'
+        return resp
+
+    def gen(last_id):
+        deadline = time.time() + STREAM_MAX_SECONDS
+        yield f"retry: {STREAM_RETRY_MS}\n\n"
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            events, resync = _FEED.wait(last_id, min(STREAM_HEARTBEAT, remaining))
+            if resync:
+                last_id = _FEED.latest()
+                yield f"id: {last_id}\nevent: resync\ndata: {json.dumps({'version': last_id})}\n\n"
+                continue
+            for ev in events:
+                last_id = ev[0]
+                obj = _event_obj(ev, symbols)
+                if obj["symbols"]:
+                    yield f"id: {last_id}\nevent: snapshot\ndata: {json.dumps(obj, ensure_ascii=False)}\n\n"
+            if not events:
+                yield ": ping\n\n"
+
+    resp = Response(gen(last_id), mimetype="text/event-stream")
+    resp.call_on_close(_STREAM_SLOTS.release)  # يُستدعى عند انتهاء المهلة أو انقطاع العميل
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+@app.route("/stream/poll")
+def stream_poll():
+    """⏳ Long-poll: ?since=<version> ينتظر حتى POLL_TIMEOUT ثانية لأول حدث جديد"""
+    try:
+        symbols = set(_query_symbols()) if request.args.get("symbols") else None
+        since = _int_arg(request.args.get("since"))
+        timeout = _int_arg(request.args.get("timeout"))
+        timeout = POLL_TIMEOUT if timeout is None else min(POLL_TIMEOUT, max(0, timeout))
+    except _BadQuery as e:
+        return _err(str(e), 400)
+    if since is None:
+        # أول طلب: لا انتظار، فقط الإصدار الحالي لبدء الاستئناف منه
+        return jsonify({"status": "OK", "version": _FEED.latest(), "resync": False, "events": []})
+    held = _POLL_SLOTS.acquire(blocking=False)
+    if not held:
+        timeout = 0   # كل مقاعد الانتظار مشغولة: نرد بالموجود فورًا والعميل يعيد الطلب
+    try:
+        events, resync = _FEED.wait(since, timeout)
+    finally:
+        if held:
+            _POLL_SLOTS.release()
+    events = [e for e in (_event_obj(ev, symbols) for ev in events) if e["symbols"]]
+    return jsonify({"status": "OK", "version": _FEED.latest(), "resync": resync, "events": events})
 
 # ------------------------ Root -----------------------------
 @app.route("/")
@@ -1343,16 +3458,50 @@ def home():
         "note": "Data cache & signals updating..."
     })
 
+# ------------------------ Refresh Engine -------------------
+# عدد الرموز التي تُحدَّث بالتوازي (كل رمز = عدة طلبات Polygon)
+REFRESH_WORKERS = max(1, int(os.environ.get("REFRESH_WORKERS", "4")))
+_REFRESH_POOL = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix="refresh")
+
+def _timed_call(fn, sym):
+    t0 = time.perf_counter()
+    try:
+        return fn(sym), None, time.perf_counter() - t0
+    except Exception as e:
+        return None, e, time.perf_counter() - t0
+
+def refresh_symbols(symbols, fn=None):
+    """
+    🔹 يحدّث مجموعة رموز بالتوازي عبر Worker Pool محدود (REFRESH_WORKERS).
+    يرجع dict {symbol: data} بنفس ترتيب symbols (الرموز الفاشلة تُستثنى).
+    زمن الدورة ≈ زمن أبطأ رمز بدل مجموع الأزمنة.
+    """
+    fn = fn or update_symbol_data
+    t0 = time.perf_counter()
+    futures = {sym: _REFRESH_POOL.submit(_timed_call, fn, sym) for sym in symbols}
+
+    results = {}
+    for sym in symbols:
+        data, err, took = futures[sym].result()
+        if err is not None:
+            print(f"❌ Failed to update {sym} ({took:.2f}s): {err}")
+        elif data:
+            results[sym] = data
+            print(f"✅ Updated {sym} ({took:.2f}s)")
+        else:
+            print(f"⚠️ No data returned for {sym} ({took:.2f}s)")
+
+    print(f"⏱️ Refresh cycle: {len(results)}/{len(symbols)} symbols in {time.perf_counter() - t0:.2f}s "
+          f"(workers={REFRESH_WORKERS})")
+    return results
+
 # ------------------------ Background Loader ----------------
 def warmup_cache():
     print("🔄 Warming up cache in background...")
-    for sym in SYMBOLS:
-        try:
-            get_symbol_data(sym)
-            print(f"✅ Cached {sym}")
-        except Exception as e:
-            print(f"⚠️ Failed to cache {sym}: {e}")
-    print("✅ Cache warm-up complete.")
+    # كل رمز يُنشر فور جاهزيته (النسخة فارغة أصلًا، فلا خلط بين دورتين)
+    refresh_symbols(SYMBOLS, fn=refresh_symbol)
+    BASELINES.flush()
+    print(f"✅ Cache warm-up complete (snapshot v{current_snapshot().version}).")
 
 
 # 🔁 التحديث التلقائي كل ساعة (بتوقيت الرياض)
@@ -1363,75 +3512,99 @@ def auto_refresh():
             now_r = dt.datetime.now(dt.timezone(dt.timedelta(hours=3)))
             print(f"🕒 Auto-refresh started at {now_r.strftime('%Y-%m-%d %H:%M:%S')} (Riyadh time)")
 
-            updated_all = {}
-            for sym in SYMBOLS:
-                try:
-                    data = update_symbol_data(sym)
-                    if data:
-                        CACHE[sym] = data
-                        updated_all[sym] = data
-                        print(f"✅ Updated {sym}")
-                    else:
-                        print(f"⚠️ No data returned for {sym}")
-                except Exception as e:
-                    print(f"❌ Failed to update {sym}: {e}")
-
-            # 🧠 حفظ النسخة الكاملة إلى all.json
-            os.makedirs(DATA_PATH, exist_ok=True)
-            updated_time = now_r.strftime("%Y-%m-%d %H:%M:%S")
-
-            with open(f"{DATA_PATH}/all.json", "w", encoding="utf-8") as f:
-                json.dump({
-                    "updated": updated_time,
-                    "symbols": SYMBOLS,
-                    "data": updated_all
-                }, f, ensure_ascii=False, indent=2)
-
-            print(f"💾 Saved auto-refresh snapshot at {updated_time} (Riyadh).")
+            # 🔹 الدورة تبني نسخة جديدة وتنشرها مرة واحدة (الرموز الفاشلة تبقى من النسخة السابقة)
+            updated_all = refresh_symbols(SYMBOLS, fn=_refresh_for_cycle)
+            snap = publish(updated_all)  # publish يحفظ صفوف الرموز في SnapshotStore
+            BASELINES.flush()            # baselines الدورة كلها في كتابة واحدة
+            FLOW_RING.save()
+            print(f"💾 Saved auto-refresh snapshot v{snap.version} at {snap.updated} (Riyadh).")
         except Exception as e:
             print(f"❌ Auto-refresh error: {e}")
 
         # ⏰ انتظر ساعة قبل التحديث القادم
         print("⏳ Waiting 1 hour for next refresh...\n")
         time.sleep(3600)
-# ---------------------- /opportunities/json ----------------------
+# ---------------------- /stats/http ----------------------
+@app.route("/stats/http")
+def stats_http():
+    """📡 عدّادات طلبات Polygon لكل endpoint (calls / bytes / latency)"""
+    return jsonify({"status": "OK", "rate_per_sec": POLY_RATE_PER_SEC, "burst": POLY_BURST,
+                    "endpoints": POLY.stats()})
+
+# ---------------------- /stats/compute ----------------------
+@app.route("/stats/compute")
+def stats_compute():
+    """⚙️ زمن مرحلة الحساب لكل وضع (inline / pool) وحجم سلسلة — لمعرفة نقطة التحوّل"""
+    return jsonify({"status": "OK", "mode": COMPUTE_MODE, "workers": COMPUTE_WORKERS,
+                    "pool_min_contracts": COMPUTE_POOL_MIN_CONTRACTS, "runs": compute_stats()})
+
+# ---------------------- /stats/pine ----------------------
+@app.route("/stats/pine")
+def stats_pine():
+    """📏 حجم وميزانية السكربتين (blocks / table) للنسخة الحالية — بلا تحديث من Polygon"""
+    snap = current_snapshot()
+    symbols = tuple(SYMBOLS)
+    out = {fmt: render(snap, symbols)[3] for fmt, render in _PINE_FORMATS.items()}
+    return jsonify({"status": "OK", "version": snap.version, "symbols": len(snap.data),
+                    "limits": {"chars": PINE_MAX_CHARS, "local_scopes": PINE_MAX_LOCAL_SCOPES,
+                               "security_calls": PINE_MAX_SECURITY_CALLS},
+                    "formats": out})
+
+# ---------------------- /opportunities ----------------------
 @app.route("/opportunities/json")
 def opportunities_json():
-    """📊 عرض ملف سجل الفرص اليومية عبر المتصفح"""
+    """📊 سجل الفرص بالشكل القديم: {"status", "count", "data": {symbol: [entries]}} (بلا ترقيم صفحات)"""
+    data = {}
+    for item in OPPORTUNITIES.query(limit=None):
+        if isinstance(item, tuple):
+            break
+        sym = item.pop("symbol")
+        data.setdefault(sym, []).append(item)
+    if not data:
+        return jsonify({"status": "empty", "message": "لم يتم إنشاء أي فرص بعد."})
+    return jsonify({"status": "OK", "count": len(data), "data": data})
+
+@app.route("/opportunities")
+def opportunities_page():
+    """📊 سجل الفرص مرقّم: ?symbol= &from=YYYY-MM-DD &to= &limit= &cursor= — النتائج تُبث على دفعات"""
+    symbol = (request.args.get("symbol") or "").upper() or None
+    date_from = request.args.get("from") or None
+    date_to = request.args.get("to") or None
+    cursor = request.args.get("cursor") or None
     try:
-        log_path = f"{DATA_PATH}/opportunities.json"
-        if not os.path.exists(log_path):
-            return jsonify({"status": "empty", "message": "لم يتم إنشاء أي فرص بعد."})
-        with open(log_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return jsonify({"status": "OK", "count": len(data), "data": data})
-    except Exception as e:
-        return jsonify({"error": str(e)})
-
+        for d in (date_from, date_to):
+            if d:
+                dt.date.fromisoformat(d)
+        limit = min(OPP_MAX_LIMIT, max(1, int(request.args.get("limit") or OPP_PAGE_LIMIT)))
+        if cursor and not re.fullmatch(r"opp-\d{6}\.jsonl:\d+", cursor):
+            raise ValueError(f"Invalid cursor: {cursor}")
+    except ValueError as e:
+        return _err(str(e), 400)
+
+    def gen():
+        yield '{"status":"OK","data":['
+        first = True
+        for item in OPPORTUNITIES.query(symbol, date_from, date_to, limit, cursor):
+            if isinstance(item, tuple):
+                yield f'],"next_cursor":{json.dumps(item[1])}}}'
+                return
+            yield ("" if first else ",") + json.dumps(item, ensure_ascii=False)
+            first = False
+
+    return Response(gen(), mimetype="application/json")
 
 
 if __name__ == "__main__":
-    load_baseline()  # 🔹 استرجاع الخط الأساسي عند الإقلاع
-
-    # 🔁 تحميل الكاش مبدئيًا
-    import threading
+    # 🔁 تحميل الكاش مبدئيًا (الـ baseline يُحمَّل من القرص عند أول استخدام)
     threading.Thread(target=warmup_cache, daemon=True).start()
     threading.Thread(target=auto_refresh, daemon=True).start()
-
-    # 🧠 حفظ أول نسخة مباشرة بعد التشغيل
-    try:
-        now_r = dt.datetime.now(dt.timezone(dt.timedelta(hours=3)))
-        updated_time = now_r.strftime("%Y-%m-%d %H:%M:%S")
-        os.makedirs(DATA_PATH, exist_ok=True)
-        with open(f"{DATA_PATH}/all.json", "w", encoding="utf-8") as f:
-            json.dump({
-                "updated": updated_time,
-                "symbols": SYMBOLS,
-                "data": CACHE
-            }, f, ensure_ascii=False, indent=2)
-        print(f"✅ Initial snapshot saved at startup ({updated_time} Riyadh).")
-    except Exception as e:
-        print(f"⚠️ Initial snapshot save failed: {e}")
+    threading.Thread(target=baseline_flusher, daemon=True).start()
 
     # 🚀 تشغيل السيرفر
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 10000)))
+    port = int(os.environ.get("PORT", 10000))
+    if ASYNC_SERVER:
+        from gevent.pywsgi import WSGIServer
+        print(f"🚀 gevent server on :{port}")
+        WSGIServer(("0.0.0.0", port), app).serve_forever()
+    else:
+        app.run(host="0.0.0.0", port=port, threaded=True)